@@ -0,0 +1,52 @@
+from __future__ import print_function
+import tensorflow as tf
+
+import threading
+
+
+class AsyncSaver():
+    """Checkpoints without stalling training on disk I/O.
+
+    save() copies the variables into host memory snapshot variables in one
+    session call and returns; a background thread then writes the snapshot
+    with a tf.train.Saver under the original variable names, so the
+    checkpoints restore with a plain Saver. The Saver keeps the last
+    max_to_keep checkpoints and writes through temporary files it renames
+    into place. A save waits for the previous one to finish.
+    """
+    def __init__(self, var_list, max_to_keep=5):
+        snapshots = {}
+        assigns = []
+        with tf.device("/cpu:0"), tf.name_scope("snapshot"):
+            for v in var_list:
+                s = tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                trainable=False, name=v.op.name,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                snapshots[v.op.name] = s
+                assigns.append(tf.assign(s, v))
+        self.snapshot_op = tf.group(*assigns)
+        self.saver = tf.train.Saver(snapshots, max_to_keep=max_to_keep)
+        self._thread = None
+        self._error = None
+
+    def _save(self, sess, save_path, global_step):
+        try:
+            self.saver.save(sess, save_path, global_step=global_step)
+        except Exception as e:
+            self._error = e
+
+    def save(self, sess, save_path, global_step=None):
+        self.wait()
+        sess.run(self.snapshot_op)
+        self._thread = threading.Thread(target=self._save,
+                                        args=(sess, save_path, global_step))
+        self._thread.start()
+
+    def wait(self):
+        """Blocks until the pending checkpoint is written."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,44 @@
+from __future__ import print_function
+import tensorflow as tf
+
+import argparse
+import os
+import shutil
+
+from model import Model
+from six.moves import cPickle
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--save_dir', type=str, default='save',
+                        help='model directory to store checkpointed models')
+    parser.add_argument('--export_dir', type=str, default='save/inference',
+                        help='directory of the exported inference checkpoint')
+
+    args = parser.parse_args()
+    export(args)
+
+
+def export(args):
+    """Writes the model weights of the latest training checkpoint, without
+    optimizer state, to export_dir together with config.pkl and
+    chars_vocab.pkl, so it can be used as the save_dir of sample.py."""
+    with open(os.path.join(args.save_dir, 'config.pkl'), 'rb') as f:
+        saved_args = cPickle.load(f)
+    # the inference graph has only the model variables
+    Model(saved_args, training=False)
+    if not os.path.isdir(args.export_dir):
+        os.makedirs(args.export_dir)
+    with tf.Session() as sess:
+        saver = tf.train.Saver(tf.global_variables())
+        ckpt = tf.train.get_checkpoint_state(args.save_dir)
+        saver.restore(sess, ckpt.model_checkpoint_path)
+        path = saver.save(sess, os.path.join(args.export_dir, 'model.ckpt'))
+    for name in ['config.pkl', 'chars_vocab.pkl']:
+        shutil.copy(os.path.join(args.save_dir, name), args.export_dir)
+    print("inference model exported to {}".format(path))
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ from __future__ import print_function
 import tensorflow as tf
 from tensorflow.contrib import rnn
 from tensorflow.contrib import legacy_seq2seq
+from tensorflow.python.util import nest
 
 import numpy as np
 import sys
@@ -27,8 +28,10 @@ class Model():
             raise Exception("model type not supported: {}".format(args.model))
 
         cells = []
+        base_cells = []
         for _ in range(args.num_layers):
             cell = cell_fn(args.rnn_size)
+            base_cells.append(cell)
             if training and (args.output_keep_prob < 1.0 or args.input_keep_prob < 1.0):
                 cell = rnn.DropoutWrapper(cell,
                                           input_keep_prob=args.input_keep_prob,
@@ -36,12 +39,27 @@ class Model():
             cells.append(cell)
 
         self.cell = cell = rnn.MultiRNNCell(cells, state_is_tuple=True)
+        # the same cells without dropout, sharing their variables, for the
+        # eval loop
+        self._eval_cell = rnn.MultiRNNCell(base_cells, state_is_tuple=True)
 
         self.input_data = tf.placeholder(
             tf.int32, [args.batch_size, args.seq_length])
         self.targets = tf.placeholder(
             tf.int32, [args.batch_size, args.seq_length])
         self.initial_state = cell.zero_state(args.batch_size, tf.float32)
+        # older saved configs have no stateful field
+        self.stateful = training and getattr(args, 'stateful', False)
+        if self.stateful:
+            # the state stays in local variables between batches, updated in
+            # place by train_op (or state_update) and zeroed by reset_state_op
+            self.state_vars = [
+                tf.Variable(s, trainable=False, name='state_%d' % i,
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                for i, s in enumerate(nest.flatten(self.initial_state))]
+            self.reset_state_op = tf.variables_initializer(self.state_vars)
+            self.initial_state = nest.pack_sequence_as(
+                self.initial_state, [v.value() for v in self.state_vars])
 
         with tf.variable_scope('rnnlm'):
             softmax_w = tf.get_variable("softmax_w",
@@ -49,6 +67,8 @@ class Model():
             softmax_b = tf.get_variable("softmax_b", [args.vocab_size])
 
         embedding = tf.get_variable("embedding", [args.vocab_size, args.rnn_size])
+        self._softmax_w, self._softmax_b = softmax_w, softmax_b
+        self._embedding = embedding
         inputs = tf.nn.embedding_lookup(embedding, self.input_data)
 
         # dropout beta testing: double check which one should affect next line
@@ -80,6 +100,15 @@ class Model():
             self.eval_cost = tf.identity(self.cost)
 
         self.final_state = last_state
+        if self.stateful:
+            self.state_update = self._assign_state(last_state)
+        if not training:
+            # inference only, no optimizer or summaries to build and restore
+            self._build_sampler()
+            self._build_beam_search()
+            self._build_scorer()
+            return
+        self._build_eval_loop()
         self.lr = tf.Variable(0.0, trainable=False)
         tvars = tf.trainable_variables()
         grads, _ = tf.clip_by_global_norm(tf.gradients(self.cost, tvars),
@@ -104,49 +133,258 @@ class Model():
                 raise Exception("please use either adam or YF")
 
         self.train_op = optimizer.apply_gradients(zip(grads, tvars))
+        if self.stateful:
+            # after the update, so the gradients still see the old state
+            with tf.control_dependencies([self.train_op]):
+                self.train_op = self._assign_state(last_state)
 
         # instrument tensorboard
-        self.train_summary = [ \
-            tf.summary.histogram('logits', self.logits),
-            tf.summary.histogram('loss', loss),
+        # cheap scalars for every step, histograms of the full logits only
+        # every so often
+        self.scalar_summary = [ \
             tf.summary.scalar('train_loss', self.cost) ]
+        self.histogram_summary = [ \
+            tf.summary.histogram('logits', self.logits),
+            tf.summary.histogram('loss', loss) ]
+        self.train_summary = self.histogram_summary + self.scalar_summary
         # self.eval_summary = [ \
         #     tf.summary.scalar('eval_loss', self.eval_cost) ]
 
 
+    def _assign_state(self, state):
+        return tf.group(*[tf.assign(v, s) for v, s in
+                          zip(self.state_vars, nest.flatten(state))])
+
+    def _step(self, x, state):
+        """One step of the cell on the [batch] ids x, returns the logits."""
+        with tf.variable_scope('rnnlm', reuse=True):
+            output, state = self.cell(
+                tf.nn.embedding_lookup(self._embedding, x), state)
+        return tf.matmul(output, self._softmax_w) + self._softmax_b, state
+
+    def _prime(self, prime):
+        """State after the cell ran over all but the last column of the
+        [batch, length] ids prime."""
+        def prime_body(t, state):
+            _, state = self._step(prime[:, t], state)
+            return t + 1, state
+        _, state = tf.while_loop(
+            lambda t, _: t < tf.shape(prime)[1] - 1, prime_body,
+            [tf.constant(0), self.cell.zero_state(tf.shape(prime)[0], tf.float32)])
+        return state
+
+    def _build_sampler(self):
+        # samples a batch of sequences on the device: one while_loop runs
+        # the cell over the prime, a second one draws num characters
+        self.sample_prime = tf.placeholder(tf.int32, [None, None])
+        self.sample_num = tf.placeholder(tf.int32, [])
+        self.sample_type = tf.placeholder_with_default(1, [])
+        self.sample_space_id = tf.placeholder_with_default(-1, [])
+        self.sample_temperature = tf.placeholder_with_default(1.0, [])
+        self.sample_top_k = tf.placeholder_with_default(0, [])
+        state = self._prime(self.sample_prime)
+
+        # top_k <= 0 keeps the whole vocabulary
+        top_k = tf.where(self.sample_top_k > 0, self.sample_top_k,
+                         self.args.vocab_size)
+
+        def sample_body(t, x, state, samples):
+            logits, state = self._step(x, state)
+            logits /= self.sample_temperature
+            kth = tf.reduce_min(tf.nn.top_k(logits, top_k).values, 1,
+                                keep_dims=True)
+            logits = tf.where(logits < kth,
+                              tf.fill(tf.shape(logits), -np.inf), logits)
+            sampled = tf.to_int32(tf.squeeze(tf.multinomial(logits, 1), [1]))
+            greedy = tf.to_int32(tf.argmax(logits, 1))
+            # sampling_type 0 is greedy, 1 samples and 2 samples after spaces
+            use_sample = tf.logical_or(
+                tf.equal(self.sample_type, 1),
+                tf.logical_and(tf.equal(self.sample_type, 2),
+                               tf.equal(x, self.sample_space_id)))
+            x = tf.where(use_sample, sampled, greedy)
+            return t + 1, x, state, samples.write(t, x)
+        _, _, _, samples = tf.while_loop(
+            lambda t, *_: t < self.sample_num, sample_body,
+            [tf.constant(0), self.sample_prime[:, -1], state,
+             tf.TensorArray(tf.int32, size=self.sample_num)])
+        self.sample_ids = tf.transpose(samples.stack())
+
+    def _build_eval_loop(self):
+        # the whole eval set in one session call: the x and y rows are
+        # loaded once into a local variable, the while_loop carries the
+        # state and sums the loss of each batch on the device. No dropout,
+        # neither on the inputs nor in the cells
+        args = self.args
+        self.eval_rows = tf.placeholder(tf.int32, [2, args.batch_size, None])
+        rows = tf.Variable(self.eval_rows, trainable=False, validate_shape=False,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                           name='eval_rows')
+        self.eval_load_op = rows.initializer
+        num_batches = tf.shape(rows)[2] // args.seq_length
+
+        def eval_body(b, state, loss_sum):
+            start = b * args.seq_length
+            x, y = [tf.reshape(rows[i, :, start:start + args.seq_length],
+                               [args.batch_size, args.seq_length])
+                    for i in range(2)]
+            inputs = tf.unstack(tf.nn.embedding_lookup(self._embedding, x), axis=1)
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                outputs, state = legacy_seq2seq.rnn_decoder(
+                    inputs, state, self._eval_cell, scope='rnnlm')
+            output = tf.reshape(tf.concat(outputs, 1), [-1, args.rnn_size])
+            logits = tf.matmul(output, self._softmax_w) + self._softmax_b
+            loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=tf.reshape(y, [-1]), logits=logits))
+            return b + 1, state, loss_sum + loss
+        _, _, loss_sum = tf.while_loop(
+            lambda b, *_: b < num_batches, eval_body,
+            [tf.constant(0), self._eval_cell.zero_state(args.batch_size, tf.float32),
+             tf.constant(0.0)])
+        self.eval_loop_cost = loss_sum / tf.to_float(num_batches)
+
+    def evaluate(self, sess, data_loader):
+        """Mean loss over the batches of data_loader without dropout, from a
+        zero state. The data is uploaded on the first call with each
+        data_loader."""
+        if getattr(self, '_eval_data_loader', None) is not data_loader:
+            rows = np.stack([data_loader.x_rows, data_loader.y_rows])
+            sess.run(self.eval_load_op, {self.eval_rows: rows})
+            self._eval_data_loader = data_loader
+        return sess.run(self.eval_loop_cost)
+
+    def _build_beam_search(self):
+        # all beams advance as one batch per step, the states of the
+        # surviving beams are gathered by parent
+        self.beam_prime = tf.placeholder(tf.int32, [None])
+        self.beam_num = tf.placeholder(tf.int32, [])
+        self.beam_width = tf.placeholder_with_default(4, [])
+        self.beam_end_id = tf.placeholder_with_default(-1, [])
+        width = self.beam_width
+        vocab_size = self.args.vocab_size
+        state = self._prime(tf.tile(tf.expand_dims(self.beam_prime, 0), [width, 1]))
+        # finished beams can only repeat the end id, at no cost
+        end_log_probs = tf.one_hot(self.beam_end_id, vocab_size,
+                                   on_value=0.0, off_value=-np.inf)
+
+        def beam_body(t, x, state, scores, lengths, finished, tokens, parents):
+            logits, state = self._step(x, state)
+            log_probs = tf.where(finished,
+                                 tf.tile(tf.expand_dims(end_log_probs, 0), [width, 1]),
+                                 tf.nn.log_softmax(logits))
+            scores, index = tf.nn.top_k(
+                tf.reshape(tf.expand_dims(scores, 1) + log_probs, [-1]), width)
+            parent = index // vocab_size
+            x = index % vocab_size
+            state = nest.map_structure(lambda s: tf.gather(s, parent), state)
+            finished = tf.gather(finished, parent)
+            lengths = tf.gather(lengths, parent) + tf.to_int32(tf.logical_not(finished))
+            finished = tf.logical_or(finished, tf.equal(x, self.beam_end_id))
+            return (t + 1, x, state, scores, lengths, finished,
+                    tokens.write(t, x), parents.write(t, parent))
+        # only the first beam is live at the start
+        scores = tf.concat([[0.0], tf.fill([width - 1], -np.inf)], 0)
+        _, _, _, scores, lengths, _, tokens, parents = tf.while_loop(
+            lambda t, x, state, scores, lengths, finished, *_: tf.logical_and(
+                t < self.beam_num, tf.logical_not(tf.reduce_all(finished))),
+            beam_body,
+            [tf.constant(0), tf.tile(self.beam_prime[-1:], [width]), state, scores,
+             tf.zeros([width], tf.int32), tf.zeros([width], tf.bool),
+             tf.TensorArray(tf.int32, size=0, dynamic_size=True),
+             tf.TensorArray(tf.int32, size=0, dynamic_size=True)])
+        self.beam_scores = scores
+        self.beam_lengths = lengths
+        self.beam_tokens = tokens.stack()
+        self.beam_parents = parents.stack()
+
+    def _build_scorer(self):
+        # log-likelihood of a padded [batch, length] batch of ids, counting
+        # the targets at positions in [score_start, score_lengths)
+        self.score_ids = tf.placeholder(tf.int32, [None, None])
+        self.score_lengths = tf.placeholder(tf.int32, [None])
+        self.score_start = tf.placeholder_with_default(1, [])
+        ids = self.score_ids
+
+        def score_body(t, state, log_likelihood):
+            logits, state = self._step(ids[:, t], state)
+            log_p = -tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=ids[:, t + 1], logits=logits)
+            scored = tf.logical_and(t + 1 >= self.score_start,
+                                    t + 1 < self.score_lengths)
+            log_likelihood += tf.where(scored, log_p, tf.zeros_like(log_p))
+            return t + 1, state, log_likelihood
+        _, _, self.score_log_likelihood = tf.while_loop(
+            lambda t, *_: t < tf.shape(ids)[1] - 1, score_body,
+            [tf.constant(0), self.cell.zero_state(tf.shape(ids)[0], tf.float32),
+             tf.zeros([tf.shape(ids)[0]])])
+
+    def _default_prime(self, chars, prime):
+        """prime, or a space (the first character of the vocabulary if it
+        has none) when prime is empty, since the sampling starts from the
+        last character of the prime."""
+        if prime:
+            return prime
+        return u' ' if u' ' in chars else chars[0]
+
+    def sample_batch(self, sess, chars, vocab, num=200, prime='The ', sampling_type=1,
+                     batch_size=1, temperature=1.0, top_k=0):
+        """batch_size samples of num characters after prime, generated in a
+        single session call. top_k <= 0 or above the vocabulary size keeps
+        the whole vocabulary."""
+        prime = self._default_prime(chars, prime)
+        top_k = min(top_k, len(chars)) if top_k > 0 else 0
+        if not hasattr(self, 'sample_ids'):
+            self._build_sampler()
+        feed = {self.sample_prime: np.tile([vocab[c] for c in prime], (batch_size, 1)),
+                self.sample_num: num,
+                self.sample_type: sampling_type,
+                self.sample_space_id: vocab.get(' ', -1),
+                self.sample_temperature: temperature,
+                self.sample_top_k: top_k}
+        ids = sess.run(self.sample_ids, feed)
+        return [prime + ''.join(chars[i] for i in row) for row in ids]
+
+    def beam_search(self, sess, chars, vocab, num=200, prime='The ', beam_width=4,
+                    end_char=None, length_alpha=0.0):
+        """The beam_width best continuations of prime with at most num
+        characters, stopping at end_char if given, as (text, score) pairs,
+        best first. The score is the log-likelihood divided by
+        length ** length_alpha."""
+        prime = self._default_prime(chars, prime)
+        if not hasattr(self, 'beam_tokens'):
+            self._build_beam_search()
+        feed = {self.beam_prime: [vocab[c] for c in prime],
+                self.beam_num: num,
+                self.beam_width: beam_width,
+                self.beam_end_id: vocab[end_char] if end_char is not None else -1}
+        scores, lengths, tokens, parents = sess.run(
+            [self.beam_scores, self.beam_lengths, self.beam_tokens,
+             self.beam_parents], feed)
+        scores = scores / np.maximum(lengths, 1) ** length_alpha
+        results = []
+        for beam in np.argsort(-scores):
+            # follow the parents back from the last step
+            ids, b = [], beam
+            for t in range(len(tokens) - 1, -1, -1):
+                ids.append(tokens[t, b])
+                b = parents[t, b]
+            ids = ids[::-1][:lengths[beam]]
+            results.append((prime + ''.join(chars[i] for i in ids), scores[beam]))
+        return results
+
+    def score(self, sess, vocab, texts, prime=''):
+        """Log-likelihood of each of texts following prime (following its
+        own first character if prime is empty), in a single session call."""
+        if not hasattr(self, 'score_log_likelihood'):
+            self._build_scorer()
+        seqs = [[vocab[c] for c in prime + text] for text in texts]
+        lengths = [len(seq) for seq in seqs]
+        ids = np.zeros([len(seqs), max(lengths)], dtype=np.int32)
+        for i, seq in enumerate(seqs):
+            ids[i, :len(seq)] = seq
+        feed = {self.score_ids: ids, self.score_lengths: lengths,
+                self.score_start: max(len(prime), 1)}
+        return sess.run(self.score_log_likelihood, feed)
+
     def sample(self, sess, chars, vocab, num=200, prime='The ', sampling_type=1):
-        state = sess.run(self.cell.zero_state(1, tf.float32))
-        for char in prime[:-1]:
-            x = np.zeros((1, 1))
-            x[0, 0] = vocab[char]
-            feed = {self.input_data: x, self.initial_state: state}
-            [state] = sess.run([self.final_state], feed)
-
-        def weighted_pick(weights):
-            t = np.cumsum(weights)
-            s = np.sum(weights)
-            return(int(np.searchsorted(t, np.random.rand(1)*s)))
-
-        ret = prime
-        char = prime[-1]
-        for n in range(num):
-            x = np.zeros((1, 1))
-            x[0, 0] = vocab[char]
-            feed = {self.input_data: x, self.initial_state: state}
-            [probs, state] = sess.run([self.probs, self.final_state], feed)
-            p = probs[0]
-
-            if sampling_type == 0:
-                sample = np.argmax(p)
-            elif sampling_type == 2:
-                if char == ' ':
-                    sample = weighted_pick(p)
-                else:
-                    sample = np.argmax(p)
-            else:  # sampling_type == 1 default:
-                sample = weighted_pick(p)
-
-            pred = chars[sample]
-            ret += pred
-            char = pred
-        return ret
+        return self.sample_batch(sess, chars, vocab, num, prime, sampling_type)[0]
@@ -0,0 +1,49 @@
+from __future__ import print_function
+import argparse
+import copy
+
+import numpy as np
+import tensorflow as tf
+
+from model import Model
+
+
+class FixedBatch():
+    """The x_rows and y_rows of a data loader holding a single batch."""
+    def __init__(self, x, y):
+        self.x_rows = x
+        self.y_rows = y
+
+
+def test_eval_loop():
+    args = argparse.Namespace(model='lstm', rnn_size=16, num_layers=2,
+                              batch_size=4, seq_length=5, vocab_size=7,
+                              grad_clip=5., input_keep_prob=0.5,
+                              output_keep_prob=0.5)
+    clean_args = copy.copy(args)
+    clean_args.input_keep_prob = 1.0
+    clean_args.output_keep_prob = 1.0
+    with tf.variable_scope("model"):
+        model = Model(args, opt_method="SGD")
+    # the same variables without dropout, for the feed dict eval loss
+    with tf.variable_scope("model", reuse=True):
+        clean_model = Model(clean_args, opt_method="SGD")
+
+    np.random.seed(1)
+    x = np.random.randint(args.vocab_size, size=[args.batch_size, args.seq_length])
+    y = np.random.randint(args.vocab_size, size=[args.batch_size, args.seq_length])
+    data_loader = FixedBatch(x, y)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        feed_loss = sess.run(clean_model.cost, {clean_model.input_data: x,
+                                                clean_model.targets: y})
+        eval_loss = model.evaluate(sess, data_loader)
+        # no dropout, so the loss is the same every time
+        assert model.evaluate(sess, data_loader) == eval_loss
+    assert np.abs(feed_loss - eval_loss) < np.abs(feed_loss) * 1e-5
+    print("eval loop test passed!")
+
+
+if __name__ == "__main__":
+    with tf.variable_scope("test_eval_loop"):
+        test_eval_loop()
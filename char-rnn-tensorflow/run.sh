@@ -14,3 +14,6 @@ do
 #  python train.py --log_dir=./results/MOM_SGD_0.05_seed_${seed}/ --data_dir=./data/tinyshakespeare/ --learning_rate=0.05 --seed=${seed} --opt_method=momSGD
 #  python train.py --log_dir=./results/MOM_SGD_5.0_seed_${seed}/ --data_dir=./data/tinyshakespeare/ --learning_rate=5.0 --seed=${seed} --opt_method=momSGD 
 done
+
+# the same sweep in one process, the runs share the data loader and batches
+#python sweep.py --log_dir=./results/sweep --data_dir=./data/tinyshakespeare/ --runs=YF:1.0:1,YF:1.0:2,YF:1.0:3,Adam:0.001:1,Adam:0.005:1,momSGD:0.1:1,momSGD:0.5:1
@@ -22,6 +22,18 @@ def main():
     parser.add_argument('--sample', type=int, default=1,
                         help='0 to use max at each timestep, 1 to sample at '
                              'each timestep, 2 to sample on spaces')
+    parser.add_argument('--n_samples', type=int, default=1,
+                        help='number of sequences sampled in parallel')
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help='softmax temperature of the sampling')
+    parser.add_argument('--top_k', type=int, default=0,
+                        help='sample among the k most likely characters, 0 for all')
+    parser.add_argument('--beam_width', type=int, default=0,
+                        help='beam search with this many beams instead of sampling, 0 to sample')
+    parser.add_argument('--length_alpha', type=float, default=0.0,
+                        help='beam scores are divided by length ** length_alpha')
+    parser.add_argument('--end_char', type=text_type, default=None,
+                        help='beams stop at this character')
 
     args = parser.parse_args()
     sample(args)
@@ -34,13 +46,20 @@ def sample(args):
         chars, vocab = cPickle.load(f)
     model = Model(saved_args, training=False)
     with tf.Session() as sess:
-        tf.global_variables_initializer().run()
         saver = tf.train.Saver(tf.global_variables())
         ckpt = tf.train.get_checkpoint_state(args.save_dir)
         if ckpt and ckpt.model_checkpoint_path:
             saver.restore(sess, ckpt.model_checkpoint_path)
-            print(model.sample(sess, chars, vocab, args.n, args.prime,
-                               args.sample).encode('utf-8'))
+            if args.beam_width > 0:
+                for text, score in model.beam_search(sess, chars, vocab, args.n, args.prime,
+                                                     args.beam_width, args.end_char,
+                                                     args.length_alpha):
+                    print("{:.3f}".format(score), text.encode('utf-8'))
+            else:
+                for text in model.sample_batch(sess, chars, vocab, args.n, args.prime,
+                                               args.sample, args.n_samples,
+                                               args.temperature, args.top_k):
+                    print(text.encode('utf-8'))
 
 if __name__ == '__main__':
     main()
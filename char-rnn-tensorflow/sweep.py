@@ -0,0 +1,161 @@
+from __future__ import print_function
+import tensorflow as tf
+import numpy as np
+
+import argparse
+import copy
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from six.moves import cPickle
+
+from utils import TextLoader
+from model import Model
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', type=str,
+                        default='YF:1.0:1,Adam:0.001:1,momSGD:0.1:1',
+                        help='comma separated opt_method:learning_rate:seed of the models trained together')
+    parser.add_argument('--data_dir', type=str, default='data/tinyshakespeare',
+                        help='data directory containing input.txt')
+    parser.add_argument('--save_dir', type=str, default='save',
+                        help='directory to store the final model of each run')
+    parser.add_argument('--log_dir', type=str, default='results',
+                        help='directory of the loss logs of each run')
+    parser.add_argument('--rnn_size', type=int, default=128,
+                        help='size of RNN hidden state')
+    parser.add_argument('--num_layers', type=int, default=2,
+                        help='number of layers in the RNN')
+    parser.add_argument('--model', type=str, default='lstm',
+                        help='rnn, gru, lstm, or nas')
+    parser.add_argument('--batch_size', type=int, default=50,
+                        help='minibatch size')
+    parser.add_argument('--seq_length', type=int, default=50,
+                        help='RNN sequence length')
+    parser.add_argument('--num_epochs', type=int, default=50,
+                        help='number of epochs')
+    parser.add_argument('--grad_clip', type=float, default=5.,
+                        help='clip gradients at this value')
+    parser.add_argument('--decay_rate', type=float, default=0.97,
+                        help='learning rate decay per epoch')
+    parser.add_argument('--output_keep_prob', type=float, default=1.0,
+                        help='probability of keeping weights in the hidden layer')
+    parser.add_argument('--input_keep_prob', type=float, default=1.0,
+                        help='probability of keeping weights in the input layer')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed of the shared batch stream')
+    parser.add_argument('--random_offset', action='store_true',
+                        help='start each training epoch at a random offset')
+    parser.add_argument('--shuffle_streams', action='store_true',
+                        help='deal the data segments to the batch streams in a random order each epoch')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='batches read ahead by a background thread, 0 to read them inline')
+    parser.add_argument('--n_core', type=int, default=16,
+                        help='cpu threads shared by all runs')
+
+    args = parser.parse_args()
+    sweep(args)
+
+
+class Run():
+    """One model of the sweep, in its own graph and session so the
+    optimizers only see their own variables."""
+    def __init__(self, args, opt_method, learning_rate, seed, n_core):
+        self.name = "{}_lr_{}_seed_{}".format(opt_method, learning_rate, seed)
+        self.args = copy.copy(args)
+        self.args.opt_method = opt_method
+        self.args.learning_rate = learning_rate
+        self.args.seed = seed
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(seed)
+            self.model = model = Model(self.args, opt_method=opt_method)
+            self.lr_decay = tf.placeholder(tf.float32, [])
+            self.lr_ops = [tf.assign(model.lr, learning_rate * self.lr_decay)]
+            if opt_method == "YF":
+                self.lr_ops.append(tf.assign(model.optimizer.lr_factor, self.lr_decay))
+            init_op = tf.global_variables_initializer()
+            self.saver = tf.train.Saver(tf.global_variables())
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(
+            intra_op_parallelism_threads=n_core,
+            inter_op_parallelism_threads=n_core))
+        self.sess.run(init_op)
+        self.log_dir = os.path.join(args.log_dir, self.name)
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        for name in ["loss.txt", "eval_loss.txt"]:
+            open(os.path.join(self.log_dir, name), "w").close()
+
+    def start_epoch(self, e):
+        self.sess.run(self.lr_ops, {self.lr_decay: self.args.decay_rate ** e})
+        self.state = self.sess.run(self.model.initial_state)
+        self.losses = []
+
+    def train_step(self, x, y):
+        model = self.model
+        feed = {model.input_data: x, model.targets: y}
+        for i, (c, h) in enumerate(model.initial_state):
+            feed[c] = self.state[i].c
+            feed[h] = self.state[i].h
+        train_loss, self.state, _ = self.sess.run(
+            [model.cost, model.final_state, model.train_op], feed)
+        self.losses.append(train_loss)
+
+    def end_epoch(self, step, eval_data_loader):
+        eval_loss = self.model.evaluate(self.sess, eval_data_loader)
+        with open(os.path.join(self.log_dir, "loss.txt"), "a") as f:
+            np.savetxt(f, np.array(self.losses))
+        with open(os.path.join(self.log_dir, "eval_loss.txt"), "a") as f:
+            np.savetxt(f, np.array([[step, eval_loss]]))
+        return eval_loss
+
+    def save(self, save_dir, data_loader):
+        save_dir = os.path.join(save_dir, self.name)
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        with open(os.path.join(save_dir, 'config.pkl'), 'wb') as f:
+            cPickle.dump(self.args, f)
+        with open(os.path.join(save_dir, 'chars_vocab.pkl'), 'wb') as f:
+            cPickle.dump((data_loader.chars, data_loader.vocab), f)
+        self.saver.save(self.sess, os.path.join(save_dir, 'model.ckpt'))
+
+
+def sweep(args):
+    # one data loader and batch stream for all the runs
+    data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length, partition='train',
+                             random_offset=args.random_offset, shuffle=args.shuffle_streams)
+    eval_data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length, partition='eval')
+    args.vocab_size = data_loader.vocab_size
+    rng = np.random.RandomState(args.seed)
+
+    specs = [run.split(":") for run in args.runs.split(",")]
+    n_core = max(1, args.n_core // len(specs))
+    runs = [Run(args, opt_method, float(lr), int(seed), n_core)
+            for opt_method, lr, seed in specs]
+
+    # the runs take each batch in lock-step, each on its own thread
+    pool = ThreadPool(len(runs))
+    for e in range(args.num_epochs):
+        for run in runs:
+            run.start_epoch(e)
+        data_loader.reset_batch_pointer(rng)
+        start = time.time()
+        for x, y in data_loader.iter_batches(args.prefetch):
+            pool.map(lambda run: run.train_step(x, y), runs)
+        end = time.time()
+        step = (e + 1) * data_loader.num_batches
+        eval_losses = pool.map(lambda run: run.end_epoch(step, eval_data_loader), runs)
+        for run, eval_loss in zip(runs, eval_losses):
+            print("{}/{} (epoch {}) {}: train_loss = {:.3f}, eval_loss = {:.3f}, time/batch = {:.3f}"
+                  .format(step, args.num_epochs * data_loader.num_batches, e, run.name,
+                          np.mean(run.losses), eval_loss,
+                          (end - start) / data_loader.num_batches))
+    pool.close()
+    for run in runs:
+        run.save(args.save_dir, data_loader)
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ from six.moves import cPickle
 
 from utils import TextLoader
 from model import Model
+from async_saver import AsyncSaver
 
 
 def main():
@@ -55,6 +56,16 @@ def main():
     parser.add_argument('--opt_method', type=str, default="YF", help="the optimizer to use")
     parser.add_argument('--seed', type=int, default=1, help="random seed for numpy and pytorch")
     parser.add_argument('--h_max_log_smooth', action='store_true')
+    parser.add_argument('--stateful', action='store_true',
+                        help='keep the RNN state in variables updated by the train op instead of feeding it back every batch')
+    parser.add_argument('--random_offset', action='store_true',
+                        help='start each training epoch at a random offset')
+    parser.add_argument('--shuffle_streams', action='store_true',
+                        help='deal the data segments to the batch streams in a random order each epoch')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='batches read ahead by a background thread, 0 to read them inline')
+    parser.add_argument('--histogram_every', type=int, default=100,
+                        help='steps between the logits and loss histogram summaries, the loss scalar is written every step')
 
     args = parser.parse_args()
 
@@ -65,9 +76,16 @@ def main():
     #with tf.device("gpu:0"):
     train(args)
 
+def append_log(path, rows):
+    with open(path, "a") as f:
+        np.savetxt(f, np.array(rows))
+
 def train(args):
-    data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length, partition='train')
+    data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length, partition='train',
+                             random_offset=args.random_offset, shuffle=args.shuffle_streams)
     eval_data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length, partition='eval')
+    # epoch offsets and stream order of the training batches
+    rng = np.random.RandomState(args.seed)
     args.vocab_size = data_loader.vocab_size
 
     # check compatibility if training is continued from previously saved model
@@ -101,11 +119,14 @@ def train(args):
         cPickle.dump((data_loader.chars, data_loader.vocab), f)
 
     model = Model(args, opt_method="YF")
+    # the loss logs are appended to as training goes
+    loss_file = args.log_dir + "/loss.txt"
+    eval_loss_file = args.log_dir + "/eval_loss.txt"
     loss_list = []
-    eval_loss_list = []
     with tf.Session() as sess:
         # instrument for tensorboard
-        summaries = tf.summary.merge(model.train_summary)
+        scalar_summaries = tf.summary.merge(model.scalar_summary)
+        histogram_summaries = tf.summary.merge(model.histogram_summary)
         writer = tf.summary.FileWriter(
                 os.path.join(args.log_dir, time.strftime("%Y-%m-%d-%H-%M-%S")))
         writer.add_graph(sess.graph)
@@ -115,27 +136,20 @@ def train(args):
         # restore model
         if args.init_from is not None:
             saver.restore(sess, ckpt.model_checkpoint_path)
+        async_saver = AsyncSaver(tf.global_variables())
+        for path in [loss_file, eval_loss_file]:
+            open(path, "w").close()
 
         # do evaluation
         e = -1
-        eval_loss = 0.0
         start = time.time()
-        eval_data_loader.reset_batch_pointer()
-        state = sess.run(model.initial_state)
-        for b in range(eval_data_loader.num_batches):
-            x, y = eval_data_loader.next_batch()
-            feed = {model.input_data: x, model.targets: y}
-            for i, (c, h) in enumerate(model.initial_state):
-                feed[c] = state[i].c
-                feed[h] = state[i].h
-            eval_loss_batch, state = sess.run([model.eval_cost, model.final_state], feed)
-            eval_loss += eval_loss_batch
-        eval_loss /= eval_data_loader.num_batches
+        # one session call over the eval set, state and loss stay on the device
+        eval_loss = model.evaluate(sess, eval_data_loader)
         # instrument for tensorboard
         summ = tf.Summary(value=[tf.Summary.Value(tag="eval_loss", simple_value=eval_loss), ])
         writer.add_summary(summ, e * data_loader.num_batches)
 
-        eval_loss_list.append( [(e + 1) * data_loader.num_batches, eval_loss] )
+        append_log(eval_loss_file, [[(e + 1) * data_loader.num_batches, eval_loss]])
         end = time.time()
         print("{}/{} (epoch {}), eval_loss = {:.3f}, time/batch = {:.3f}"
               .format( (e + 1) * data_loader.num_batches,
@@ -146,20 +160,35 @@ def train(args):
             sess.run(tf.assign(model.lr,
                                args.learning_rate * (args.decay_rate ** e)))
             sess.run(tf.assign(model.optimizer.lr_factor, args.decay_rate ** e))
-            data_loader.reset_batch_pointer()
-            state = sess.run(model.initial_state)
-            for b in range(data_loader.num_batches):
+            data_loader.reset_batch_pointer(rng)
+            if args.stateful:
+                sess.run(model.reset_state_op)
+            else:
+                state = sess.run(model.initial_state)
+            for b, (x, y) in enumerate(data_loader.iter_batches(args.prefetch)):
                 start = time.time()
-                x, y = data_loader.next_batch()
                 feed = {model.input_data: x, model.targets: y}
-                for i, (c, h) in enumerate(model.initial_state):
-                    feed[c] = state[i].c
-                    feed[h] = state[i].h
                 # train_loss, state, _ = sess.run([model.cost, model.final_state, model.train_op], feed)
 
-                # instrument for tensorboard
-                summ, train_loss, state, _ = sess.run([summaries, model.cost, model.final_state, model.train_op], feed)
-                writer.add_summary(summ, e * data_loader.num_batches + b)
+                # instrument for tensorboard, the histogram ops only run
+                # when they are fetched
+                step = e * data_loader.num_batches + b
+                fetches = {"summ": scalar_summaries, "train_loss": model.cost,
+                           "train_op": model.train_op}
+                if step % args.histogram_every == 0:
+                    fetches["hist_summ"] = histogram_summaries
+                if not args.stateful:
+                    for i, (c, h) in enumerate(model.initial_state):
+                        feed[c] = state[i].c
+                        feed[h] = state[i].h
+                    fetches["final_state"] = model.final_state
+                vals = sess.run(fetches, feed)
+                train_loss = vals["train_loss"]
+                if not args.stateful:
+                    state = vals["final_state"]
+                writer.add_summary(vals["summ"], step)
+                if "hist_summ" in vals:
+                    writer.add_summary(vals["hist_summ"], step)
 
                 loss_list.append(train_loss)
 
@@ -173,30 +202,20 @@ def train(args):
                             b == data_loader.num_batches-1):
                     # save for the last result
                     checkpoint_path = os.path.join(args.save_dir, 'model.ckpt')
-                    saver.save(sess, checkpoint_path,
-                               global_step=e * data_loader.num_batches + b)
+                    async_saver.save(sess, checkpoint_path,
+                                     global_step=e * data_loader.num_batches + b)
                     print("model saved to {}".format(checkpoint_path))
 
             # do evaluation
-            eval_loss = 0.0
             start = time.time()
             print("start evaluation")
-            eval_data_loader.reset_batch_pointer()
-            state = sess.run(model.initial_state)
-            for b in range(eval_data_loader.num_batches):
-                x, y = eval_data_loader.next_batch()
-                feed = {model.input_data: x, model.targets: y}
-                for i, (c, h) in enumerate(model.initial_state):
-                    feed[c] = state[i].c
-                    feed[h] = state[i].h
-                eval_loss_batch, state = sess.run([model.eval_cost, model.final_state], feed)
-                eval_loss += eval_loss_batch
-            eval_loss /= eval_data_loader.num_batches
+            # one session call over the eval set, state and loss stay on the device
+            eval_loss = model.evaluate(sess, eval_data_loader)
             # instrument for tensorboard
             summ = tf.Summary(value=[tf.Summary.Value(tag="eval_loss", simple_value=eval_loss), ])
             writer.add_summary(summ, e * data_loader.num_batches)
 
-            eval_loss_list.append( [(e + 1) * data_loader.num_batches, eval_loss] )
+            append_log(eval_loss_file, [[(e + 1) * data_loader.num_batches, eval_loss]])
             end = time.time()
             print("{}/{} (epoch {}), eval_loss = {:.3f}, time/batch = {:.3f}"
                   .format( (e + 1) * data_loader.num_batches,
@@ -204,10 +223,9 @@ def train(args):
                           e, eval_loss, end - start))
             
 
-            with open(args.log_dir + "/loss.txt", "w") as f:
-                np.savetxt(f, np.array(loss_list) )
-            with open(args.log_dir + "/eval_loss.txt", "w") as f:
-                np.savetxt(f, np.array(eval_loss_list) )
+            append_log(loss_file, loss_list)
+            loss_list = []
+        async_saver.wait()
 
 if __name__ == '__main__':
     main()
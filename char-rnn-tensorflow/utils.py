@@ -1,20 +1,93 @@
 from __future__ import print_function
 import codecs
 import os
-import collections
-from six.moves import cPickle
+import multiprocessing
+import threading
+from six.moves import cPickle, queue
 import numpy as np
 from math import floor
 list
 TRAIN_PORTION = 0.95
 TEST_PORTION = 0.05
+# bytes read and encoded at a time by preprocess
+CHUNK_SIZE = 1 << 24
+NUM_CODE_POINTS = 0x110000
+NOT_SEEN = np.iinfo(np.int64).max
+# segments each batch stream is cut into when the streams are shuffled
+SHUFFLE_SEGMENTS = 10
+
+
+def _code_points(input_file, encoding, start, end):
+    """Code points of the characters in bytes [start, end) of input_file,
+    one array per chunk."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            data = f.read(min(CHUNK_SIZE, end - start))
+            start += len(data)
+            text = decoder.decode(data, final=start >= end)
+            yield np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+def _split_file(input_file, encoding, num_parts):
+    """Byte offsets splitting input_file into num_parts ranges at character
+    boundaries. Only utf-8 files are split."""
+    size = os.path.getsize(input_file)
+    if codecs.lookup(encoding).name != 'utf-8':
+        num_parts = 1
+    bounds = [0]
+    with open(input_file, 'rb') as f:
+        for i in range(1, num_parts):
+            pos = max(size * i // num_parts, bounds[-1])
+            f.seek(pos)
+            # skip utf-8 continuation bytes
+            while pos < size and ord(f.read(1)) & 0xC0 == 0x80:
+                pos += 1
+            bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _count_range(args):
+    """Character histogram, first position of each character and number
+    of characters of a byte range."""
+    input_file, encoding, start, end = args
+    counts = np.zeros(NUM_CODE_POINTS, dtype=np.int64)
+    first = np.full(NUM_CODE_POINTS, NOT_SEEN, dtype=np.int64)
+    size = 0
+    for codes in _code_points(input_file, encoding, start, end):
+        if codes.size == 0:
+            continue
+        np.minimum.at(first, codes, np.arange(size, size + codes.size))
+        counts[:codes.max() + 1] += np.bincount(codes)
+        size += codes.size
+    return counts, first, size
+
+
+def _encode_range(args):
+    """Writes the ids of a byte range at offset of the memory mapped
+    tensor_file."""
+    input_file, encoding, start, end, tensor_file, offset, lookup = args
+    tensor = np.load(tensor_file, mmap_mode='r+')
+    for codes in _code_points(input_file, encoding, start, end):
+        tensor[offset:offset + codes.size] = lookup[codes]
+        offset += codes.size
+    tensor.flush()
 
 class TextLoader():
-    def __init__(self, data_dir, batch_size, seq_length, partition='train', encoding='utf-8'):
+    def __init__(self, data_dir, batch_size, seq_length, partition='train', encoding='utf-8',
+                 num_workers=None, random_offset=False, shuffle=False):
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.seq_length = seq_length
         self.encoding = encoding
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        # with an rng passed to reset_batch_pointer, start each epoch at a
+        # random offset (one batch fewer per epoch) and/or deal the data
+        # segments to the batch streams in a random order
+        self.random_offset = random_offset
+        self.shuffle = shuffle
 
         input_file = os.path.join(data_dir, "input.txt")
         vocab_file = os.path.join(data_dir, "vocab.pkl")
@@ -30,30 +103,73 @@ class TextLoader():
         self.reset_batch_pointer()
 
     def preprocess(self, input_file, vocab_file, tensor_file):
-        with codecs.open(input_file, "r", encoding=self.encoding) as f:
-            data = f.read()
-        counter = collections.Counter(data)
-        count_pairs = sorted(counter.items(), key=lambda x: -x[1])
-        self.chars, _ = zip(*count_pairs)
-        self.vocab_size = len(self.chars)
-        self.vocab = dict(zip(self.chars, range(len(self.chars))))
-        with open(vocab_file, 'wb') as f:
-            cPickle.dump(self.chars, f)
-        self.tensor = np.array(list(map(self.vocab.get, data)))
-        np.save(tensor_file, self.tensor)
+        # two passes over the file in chunks, split across worker processes
+        # for large files. The first counts the characters, the second
+        # encodes them through a lookup table straight into a memory mapped
+        # data.npy, so the text is never held in memory as a whole.
+        num_parts = min(self.num_workers,
+                        -(-os.path.getsize(input_file) // CHUNK_SIZE))
+        ranges = _split_file(input_file, self.encoding, max(num_parts, 1))
+        pool = multiprocessing.Pool(len(ranges)) if len(ranges) > 1 else None
+        map_fn = pool.map if pool is not None else map
+        try:
+            counts = np.zeros(NUM_CODE_POINTS, dtype=np.int64)
+            first = np.full(NUM_CODE_POINTS, NOT_SEEN, dtype=np.int64)
+            offsets = []
+            size = 0
+            for range_counts, range_first, range_size in map_fn(
+                    _count_range, [(input_file, self.encoding, start, end)
+                                   for start, end in ranges]):
+                counts += range_counts
+                seen = range_first != NOT_SEEN
+                first[seen] = np.minimum(first[seen], size + range_first[seen])
+                offsets.append(size)
+                size += range_size
+            # most frequent first, ties in order of first occurrence
+            codes = np.nonzero(counts)[0]
+            codes = codes[np.lexsort((first[codes], -counts[codes]))]
+            self.chars = tuple(codes.astype(np.uint32).tobytes().decode('utf-32-le'))
+            self.vocab_size = len(self.chars)
+            self.vocab = dict(zip(self.chars, range(len(self.chars))))
+            with open(vocab_file, 'wb') as f:
+                cPickle.dump(self.chars, f)
+
+            if self.vocab_size <= 1 << 8:
+                dtype = np.uint8
+            elif self.vocab_size <= 1 << 16:
+                dtype = np.uint16
+            else:
+                dtype = np.int32
+            lookup = np.zeros(codes.max() + 1, dtype=dtype)
+            lookup[codes] = np.arange(self.vocab_size)
+            # allocate data.npy, the workers write into it
+            np.lib.format.open_memmap(
+                tensor_file, mode='w+', dtype=dtype, shape=(size,)).flush()
+            list(map_fn(_encode_range,
+                        [(input_file, self.encoding, start, end, tensor_file,
+                          offset, lookup)
+                         for (start, end), offset in zip(ranges, offsets)]))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.tensor = np.load(tensor_file, mmap_mode='r')
 
     def load_preprocessed(self, vocab_file, tensor_file):
         with open(vocab_file, 'rb') as f:
             self.chars = cPickle.load(f)
         self.vocab_size = len(self.chars)
         self.vocab = dict(zip(self.chars, range(len(self.chars))))
-        self.tensor = np.load(tensor_file)
+        self.tensor = np.load(tensor_file, mmap_mode='r')
         self.num_batches = int(self.tensor.size / (self.batch_size *
                                                    self.seq_length))
 
     def create_batches(self, partition='train'):
+        # x and y batches are views of the (memory mapped) tensor
+        data = self.tensor
         self.num_batches = int(self.tensor.size / (self.batch_size *
                                                    self.seq_length))
+        offset = 0
         if partition == 'train':
             self.num_batches = int(self.num_batches * TRAIN_PORTION)
             self.tensor = self.tensor[:self.num_batches * self.batch_size * self.seq_length]
@@ -71,19 +187,86 @@ class TextLoader():
             assert False, "Not enough data. Make seq_length and batch_size small."
 
         # self.tensor = self.tensor[:self.num_batches * self.batch_size * self.seq_length]
-        xdata = self.tensor
-        ydata = np.copy(self.tensor)
-        ydata[:-1] = xdata[1:]
-        ydata[-1] = xdata[0]
-        self.x_batches = np.split(xdata.reshape(self.batch_size, -1),
-                                  self.num_batches, 1)
-        self.y_batches = np.split(ydata.reshape(self.batch_size, -1),
-                                  self.num_batches, 1)
+        self._data = data
+        self._offset = offset
+        if self.random_offset:
+            # the last batch leaves room for the shifted epochs
+            self.num_batches -= 1
+            assert self.num_batches > 0, "Not enough data. Make seq_length and batch_size small."
+        if self.shuffle:
+            # whole segments per stream, dropping the batches left over
+            self.num_segments = min(SHUFFLE_SEGMENTS, self.num_batches)
+            self.segment_batches = self.num_batches // self.num_segments
+            self.num_batches = self.segment_batches * self.num_segments
+        self._set_rows(0)
+
+    def _set_rows(self, shift):
+        start = self._offset + shift
+        end = start + self.num_batches * self.batch_size * self.seq_length
+        xdata = self._data[start:end]
+        if end < self._data.size:
+            # the targets are the same data shifted by one
+            ydata = self._data[start + 1:end + 1]
+        else:
+            # no character after the partition, the last target wraps
+            # around to the first one
+            ydata = np.empty_like(xdata)
+            ydata[:-1] = xdata[1:]
+            ydata[-1] = xdata[0]
+        self.x_rows = xdata.reshape(self.batch_size, -1)
+        self.y_rows = ydata.reshape(self.batch_size, -1)
+        if self.shuffle:
+            self.x_segments = xdata.reshape(self.batch_size * self.num_segments, -1)
+            self.y_segments = ydata.reshape(self.batch_size * self.num_segments, -1)
 
     def next_batch(self):
-        x, y = self.x_batches[self.pointer], self.y_batches[self.pointer]
+        if self.segment_order is not None:
+            # each stream reads its dealt segments one after the other
+            segment, i = divmod(self.pointer, self.segment_batches)
+            rows = self.segment_order[:, segment]
+            start = i * self.seq_length
+            x = self.x_segments[rows, start:start + self.seq_length]
+            y = self.y_segments[rows, start:start + self.seq_length]
+        else:
+            start = self.pointer * self.seq_length
+            x = self.x_rows[:, start:start + self.seq_length]
+            y = self.y_rows[:, start:start + self.seq_length]
         self.pointer += 1
         return x, y
 
-    def reset_batch_pointer(self):
+    def iter_batches(self, prefetch=0):
+        """The remaining batches of the epoch. With prefetch > 0 a background
+        thread reads up to prefetch batches ahead into a bounded queue."""
+        if prefetch <= 0:
+            while self.pointer < self.num_batches:
+                yield self.next_batch()
+            return
+        batches = queue.Queue(prefetch)
+        num_batches = self.num_batches - self.pointer
+
+        def fill():
+            for _ in range(num_batches):
+                x, y = self.next_batch()
+                batches.put((np.array(x), np.array(y)))
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+        for _ in range(num_batches):
+            yield batches.get()
+        thread.join()
+
+    def reset_batch_pointer(self, rng=None):
+        """Rewinds to the first batch. With rng, shifts the epoch by a random
+        offset if random_offset is set, and if shuffle is set cuts the data
+        into batch_size * num_segments segments and deals them to the
+        streams in a random order, so the streams and the batches hold
+        different text each epoch. The RNN state then carries over a jump
+        in the text at the segment boundaries."""
         self.pointer = 0
+        self.segment_order = None
+        if rng is not None and self.random_offset:
+            self._set_rows(rng.randint(self.seq_length))
+        if rng is not None and self.shuffle:
+            self.segment_order = rng.permutation(
+                self.batch_size * self.num_segments).reshape(
+                    self.batch_size, self.num_segments)
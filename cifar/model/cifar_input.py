@@ -18,7 +18,7 @@
 
 import tensorflow as tf
 
-def build_input(dataset, data_path, batch_size, mode):
+def build_input(dataset, data_path, batch_size, mode, data_format='NHWC'):
   """Build CIFAR image and labels.
 
   Args:
@@ -26,8 +26,11 @@ def build_input(dataset, data_path, batch_size, mode):
     data_path: Filename for data.
     batch_size: Input batch size.
     mode: Either 'train' or 'eval'.
+    data_format: Either 'NHWC' or 'NCHW'. With 'NCHW' the images keep the
+      depth major layout of the CIFAR records and are never transposed.
   Returns:
-    images: Batches of images. [batch_size, image_size, image_size, 3]
+    images: Batches of images. [batch_size, image_size, image_size, 3], or
+      [batch_size, 3, image_size, image_size] for 'NCHW'.
     labels: Batches of labels. [batch_size, num_classes]
   Raises:
     ValueError: when the specified dataset is not supported.
@@ -60,14 +63,27 @@ def build_input(dataset, data_path, batch_size, mode):
   # Convert from string to [depth * height * width] to [depth, height, width].
   depth_major = tf.reshape(tf.slice(record, [label_bytes], [image_bytes]),
                            [depth, image_size, image_size])
-  # Convert from [depth, height, width] to [height, width, depth].
-  image = tf.cast(tf.transpose(depth_major, [1, 2, 0]), tf.float32)
+  if data_format == 'NCHW':
+    image = tf.cast(depth_major, tf.float32)
+    image_shape = [depth, image_size, image_size]
+  else:
+    # Convert from [depth, height, width] to [height, width, depth].
+    image = tf.cast(tf.transpose(depth_major, [1, 2, 0]), tf.float32)
+    image_shape = [image_size, image_size, depth]
 
   if mode == 'train':
-    image = tf.image.resize_image_with_crop_or_pad(
-        image, image_size+4, image_size+4)
-    image = tf.random_crop(image, [image_size, image_size, 3])
-    image = tf.image.random_flip_left_right(image)
+    if data_format == 'NCHW':
+      # The tf.image ops expect [height, width, depth], so pad, crop and
+      # flip the depth major image directly.
+      image = tf.pad(image, [[0, 0], [2, 2], [2, 2]])
+      image = tf.random_crop(image, image_shape)
+      image = tf.cond(tf.less(tf.random_uniform([]), 0.5),
+                      lambda: tf.reverse(image, [2]), lambda: image)
+    else:
+      image = tf.image.resize_image_with_crop_or_pad(
+          image, image_size+4, image_size+4)
+      image = tf.random_crop(image, image_shape)
+      image = tf.image.random_flip_left_right(image)
     # Brightness/saturation/constrast provides small gains .2%~.5% on cifar.
     # image = tf.image.random_brightness(image, max_delta=63. / 255.)
     # image = tf.image.random_saturation(image, lower=0.5, upper=1.5)
@@ -78,17 +94,18 @@ def build_input(dataset, data_path, batch_size, mode):
         capacity=16 * batch_size,
         min_after_dequeue=8 * batch_size,
         dtypes=[tf.float32, tf.int32],
-        shapes=[[image_size, image_size, depth], [1]])
+        shapes=[image_shape, [1]])
     num_threads = 16
   else:
-    image = tf.image.resize_image_with_crop_or_pad(
-        image, image_size, image_size)
+    if data_format != 'NCHW':
+      image = tf.image.resize_image_with_crop_or_pad(
+          image, image_size, image_size)
     image = tf.image.per_image_standardization(image)
 
     example_queue = tf.FIFOQueue(
         3 * batch_size,
         dtypes=[tf.float32, tf.int32],
-        shapes=[[image_size, image_size, depth], [1]])
+        shapes=[image_shape, [1]])
     num_threads = 1
 
   example_enqueue_op = example_queue.enqueue([image, label])
@@ -105,11 +122,14 @@ def build_input(dataset, data_path, batch_size, mode):
 
   assert len(images.get_shape()) == 4
   assert images.get_shape()[0] == batch_size
-  assert images.get_shape()[-1] == 3
+  assert images.get_shape()[1 if data_format == 'NCHW' else -1] == 3
   assert len(labels.get_shape()) == 2
   assert labels.get_shape()[0] == batch_size
   assert labels.get_shape()[1] == num_classes
 
   # Display the training images in the visualizer.
-  tf.summary.image('images', images)
+  if data_format == 'NCHW':
+    tf.summary.image('images', tf.transpose(images, [0, 2, 3, 1]))
+  else:
+    tf.summary.image('images', images)
   return images, labels
\ No newline at end of file
@@ -0,0 +1,246 @@
+"""Inference only ResNet with batch norm folded into the weights.
+
+export_inference_weights reads a trained ResNet out of a session into a
+NumPy weight bundle. Batch norms that directly follow a convolution are
+folded into the kernel and a bias, the others (after a residual sum) become
+a per channel scale and shift. InferenceResNet builds a frozen graph over the
+bundle with no summaries, moving statistics or training ops, and runs batch
+inference on raw [N, 32, 32, 3] images.
+"""
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+import six
+
+# batch norm epsilon used by ResNet._batch_norm and ResNet._fused_batch_norm
+BN_EPSILON = 0.001
+
+
+def fold_batch_norm(kernel, gamma, beta, mean, variance, epsilon=BN_EPSILON):
+  """Fold a batch norm into the convolution in front of it.
+
+  Returns (kernel, bias) with conv(x, kernel) + bias equal to
+  batch_norm(conv(x, kernel)) under the moving statistics.
+  """
+  scale = gamma / np.sqrt(variance + epsilon)
+  return kernel * scale, beta - mean * scale
+
+
+def bn_scale_shift(gamma, beta, mean, variance, epsilon=BN_EPSILON):
+  """Batch norm under the moving statistics as x * scale + shift."""
+  scale = gamma / np.sqrt(variance + epsilon)
+  return scale, beta - mean * scale
+
+
+def _unit_configs(hps):
+  """(scope, in_filter, out_filter, stride, activate_before_residual) of each
+  residual unit, in the order ResNet._build_model builds them."""
+  strides = [1, 2, 2]
+  activate_before_residual = [True, False, False]
+  if hps.use_bottleneck:
+    filters = [16, 64, 128, 256]
+  else:
+    filters = [16, 16, 32, 64]
+  configs = []
+  for stage in range(3):
+    configs.append(('unit_%d_0' % (stage + 1), filters[stage],
+                    filters[stage + 1], strides[stage],
+                    activate_before_residual[stage]))
+    for i in six.moves.range(1, hps.num_residual_units):
+      configs.append(('unit_%d_%d' % (stage + 1, i), filters[stage + 1],
+                      filters[stage + 1], 1, False))
+  return configs
+
+
+def _bn_scope(hps, activate_before_residual):
+  if hps.use_bottleneck:
+    return 'common_bn_relu' if activate_before_residual else 'residual_bn_relu'
+  return ('shared_activation' if activate_before_residual
+          else 'residual_only_activation')
+
+
+def export_inference_weights(sess, hps, path=None):
+  """Export a trained ResNet as a weight bundle with folded batch norm.
+
+  Args:
+    sess: Session holding the trained variables.
+    hps: HParams the model was built with.
+    path: Optional .npz file to save the bundle to.
+  Returns:
+    Dict from weight name to NumPy array, the input of InferenceResNet.
+  """
+  # look up the variable objects rather than their :0 tensors, which are
+  # handles for the resource variables of recomputed units
+  variables = dict((v.op.name, v) for v in tf.global_variables())
+  fetches = {}
+  def var(name):
+    if name not in fetches:
+      fetches[name] = variables['%s/%s' % (hps.model_scope, name)]
+    return name
+  def bn(name):
+    return [var(name + '/' + p) for p in
+            ('gamma', 'beta', 'moving_mean', 'moving_variance')]
+
+  # collect what to fetch, then read all of it in one run
+  plan = []
+  for scope, in_filter, out_filter, stride, abr in _unit_configs(hps):
+    plan.append((scope, in_filter, out_filter, abr,
+                 bn('%s/%s/init_bn' % (scope, _bn_scope(hps, abr)))))
+  var('init/init_conv/DW')
+  bn('unit_last/final_bn')
+  var('logit/DW')
+  var('logit/biases')
+  for scope, in_filter, out_filter, _, _ in plan:
+    var(scope + '/sub1/conv1/DW')
+    bn(scope + '/sub2/bn2')
+    var(scope + '/sub2/conv2/DW')
+    if hps.use_bottleneck:
+      bn(scope + '/sub3/bn3')
+      var(scope + '/sub3/conv3/DW')
+      if in_filter != out_filter:
+        var(scope + '/sub_add/project/DW')
+  v = sess.run(fetches)
+  def bn_values(name):
+    return [v[name + '/' + p] for p in
+            ('gamma', 'beta', 'moving_mean', 'moving_variance')]
+
+  bundle = {}
+  for i, (scope, in_filter, out_filter, abr, init_bn) in enumerate(plan):
+    init_bn = [v[name] for name in init_bn]
+    if i == 0:
+      # the first unit's init_bn is only fed by the init conv
+      bundle['init/kernel'], bundle['init/bias'] = fold_batch_norm(
+        v['init/init_conv/DW'], *init_bn)
+    else:
+      bundle[scope + '/init_bn/scale'], bundle[scope + '/init_bn/shift'] = \
+        bn_scale_shift(*init_bn)
+    bundle[scope + '/conv1/kernel'], bundle[scope + '/conv1/bias'] = \
+      fold_batch_norm(v[scope + '/sub1/conv1/DW'],
+                      *bn_values(scope + '/sub2/bn2'))
+    if hps.use_bottleneck:
+      bundle[scope + '/conv2/kernel'], bundle[scope + '/conv2/bias'] = \
+        fold_batch_norm(v[scope + '/sub2/conv2/DW'],
+                        *bn_values(scope + '/sub3/bn3'))
+      bundle[scope + '/conv3/kernel'] = v[scope + '/sub3/conv3/DW']
+      if in_filter != out_filter:
+        bundle[scope + '/project/kernel'] = v[scope + '/sub_add/project/DW']
+    else:
+      bundle[scope + '/conv2/kernel'] = v[scope + '/sub2/conv2/DW']
+  bundle['final_bn/scale'], bundle['final_bn/shift'] = \
+    bn_scale_shift(*bn_values('unit_last/final_bn'))
+  bundle['logit/w'] = v['logit/DW']
+  bundle['logit/b'] = v['logit/biases']
+
+  if path is not None:
+    np.savez(path, **bundle)
+  return bundle
+
+
+class InferenceResNet(object):
+  """Frozen inference graph over a weight bundle from export_inference_weights.
+
+  Images are fed as raw [N, 32, 32, 3] pixels, the per image standardization
+  of cifar_input is part of the graph.
+  """
+
+  def __init__(self, hps, bundle, n_core=None):
+    """
+    Args:
+      hps: HParams the model was trained with.
+      bundle: Dict from export_inference_weights, or the path of its .npz.
+      n_core: Optional number of intra and inter op threads.
+    """
+    if isinstance(bundle, six.string_types):
+      bundle = dict(np.load(bundle))
+    self.hps = hps
+    self._bundle = bundle
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.images = tf.placeholder(tf.float32, [None, 32, 32, 3], 'images')
+      self.logits = self._build(self.images)
+      self.predictions = tf.nn.softmax(self.logits, name='predictions')
+    self.graph.finalize()
+    if n_core is not None:
+      config = tf.ConfigProto(intra_op_parallelism_threads=n_core,
+                              inter_op_parallelism_threads=n_core)
+    else:
+      config = None
+    self.sess = tf.Session(graph=self.graph, config=config)
+
+  def _w(self, name):
+    return tf.constant(self._bundle[name], tf.float32,
+                       name=name.replace('/', '_'))
+
+  def _relu(self, x):
+    if self.hps.relu_leakiness == 0.0:
+      return tf.nn.relu(x)
+    return tf.maximum(x, self.hps.relu_leakiness * x)
+
+  def _conv(self, name, x, stride, bias=True):
+    x = tf.nn.conv2d(x, self._w(name + '/kernel'), [1, stride, stride, 1],
+                     padding='SAME')
+    if bias:
+      x = tf.nn.bias_add(x, self._w(name + '/bias'))
+    return x
+
+  def _scale_shift(self, name, x):
+    return x * self._w(name + '/scale') + self._w(name + '/shift')
+
+  def _build(self, images):
+    # vectorized tf.image.per_image_standardization
+    mean, variance = tf.nn.moments(images, [1, 2, 3], keep_dims=True)
+    min_std = 1.0 / np.sqrt(32 * 32 * 3)
+    x = (images - mean) / tf.maximum(tf.sqrt(variance), min_std)
+
+    configs = _unit_configs(self.hps)
+    # init conv with the first unit's init_bn folded in
+    x = self._conv('init', x, 1)
+    for i, (scope, in_filter, out_filter, stride, abr) in enumerate(configs):
+      with tf.name_scope(scope):
+        if i == 0:
+          x = self._relu(x)
+          orig_x = x
+        elif abr:
+          x = self._relu(self._scale_shift(scope + '/init_bn', x))
+          orig_x = x
+        else:
+          orig_x = x
+          x = self._relu(self._scale_shift(scope + '/init_bn', x))
+
+        x = self._relu(self._conv(scope + '/conv1', x, stride))
+        if self.hps.use_bottleneck:
+          x = self._relu(self._conv(scope + '/conv2', x, 1))
+          x = self._conv(scope + '/conv3', x, 1, bias=False)
+          if in_filter != out_filter:
+            orig_x = self._conv(scope + '/project', orig_x, stride, bias=False)
+        else:
+          x = self._conv(scope + '/conv2', x, 1, bias=False)
+          if in_filter != out_filter:
+            orig_x = tf.nn.avg_pool(orig_x, [1, stride, stride, 1],
+                                    [1, stride, stride, 1], 'VALID')
+            pad = (out_filter - in_filter) // 2
+            orig_x = tf.pad(orig_x, [[0, 0], [0, 0], [0, 0], [pad, pad]])
+        x += orig_x
+
+    x = self._relu(self._scale_shift('final_bn', x))
+    x = tf.reduce_mean(x, [1, 2])
+    return tf.nn.xw_plus_b(x, self._w('logit/w'), self._w('logit/b'))
+
+  def predict(self, images, batch_size=256):
+    """Class probabilities for raw [N, 32, 32, 3] images, in batches."""
+    probs = []
+    for start in six.moves.range(0, len(images), batch_size):
+      probs.append(self.sess.run(
+        self.predictions,
+        feed_dict={self.images: images[start:start + batch_size]}))
+    return np.concatenate(probs, axis=0)
+
+  def save_frozen_graph(self, path):
+    """Write the frozen GraphDef, with inputs 'images' and outputs
+    'predictions'."""
+    with tf.gfile.GFile(path, 'wb') as f:
+      f.write(self.graph.as_graph_def().SerializeToString())
+
+  def close(self):
+    self.sess.close()
@@ -22,6 +22,7 @@ https://arxiv.org/pdf/1605.07146v1.pdf
 """
 from __future__ import print_function
 from collections import namedtuple
+from distutils.version import LooseVersion
 
 import numpy as np
 import tensorflow as tf
@@ -42,7 +43,15 @@ HParams = namedtuple('HParams',
                      'batch_size, num_classes, '
                      'min_lrn_rate, lrn_rate, mom, clip_norm_base,'
                      'num_residual_units, use_bottleneck, weight_decay_rate, '
-                     'relu_leakiness, optimizer, model_scope, h_max_log_smooth')
+                     'relu_leakiness, optimizer, model_scope, h_max_log_smooth, '
+                     'fused_bn, recompute, data_format, decoupled_decay')
+
+# decay for the batch norm moving mean and variance
+BN_MOVING_AVG_DECAY = 0.9
+
+# tf.contrib.layers.recompute_grad with the is_recomputing kwarg, built on
+# tf.custom_gradient, which needs resource variables
+MIN_RECOMPUTE_TF_VERSION = '1.8'
 
 
 class ResNet(object):
@@ -53,7 +62,9 @@ class ResNet(object):
 
     Args:
       hps: Hyperparameters.
-      images: Batches of images. [batch_size, image_size, image_size, 3]
+      images: Batches of images. [batch_size, image_size, image_size, 3],
+        or [batch_size, 3, image_size, image_size] if hps.data_format is
+        'NCHW'.
       labels: Batches of labels. [batch_size, num_classes]
       mode: One of 'train' and 'eval'.
     """
@@ -63,6 +74,13 @@ class ResNet(object):
     self.mode = mode
 
     self._extra_train_ops = []
+    # (moving statistic, batch statistic) pairs from the fused batch norm,
+    # updated by a single grouped op in _build_train_op
+    self._bn_moving_stats = []
+    # set while a residual unit is rebuilt for the backward pass
+    self._is_recomputing = False
+    # weights subject to weight decay, registered as they are created
+    self._decay_vars = []
 
   def build_graph(self):
     """Build a whole graph for the model."""
@@ -76,8 +94,16 @@ class ResNet(object):
 
   def _stride_arr(self, stride):
     """Map a stride scalar to the stride array for tf.nn.conv2d."""
+    if self.hps.data_format == 'NCHW':
+      return [1, 1, stride, stride]
     return [1, stride, stride, 1]
 
+  def _num_channels(self, x):
+    """Number of channels of a 4-D feature map in hps.data_format."""
+    if self.hps.data_format == 'NCHW':
+      return x.get_shape()[1]
+    return x.get_shape()[-1]
+
   def _build_model(self):
     """Build the core model within the graph."""
     with tf.variable_scope('init'):
@@ -100,29 +126,34 @@ class ResNet(object):
       # Update hps.num_residual_units to 4
 
     with tf.variable_scope('unit_1_0'):
-      x = res_func(x, filters[0], filters[1], self._stride_arr(strides[0]),
-                   activate_before_residual[0])
+      x = self._residual_unit(0, res_func, x, filters[0], filters[1],
+                              self._stride_arr(strides[0]),
+                              activate_before_residual[0])
     for i in six.moves.range(1, self.hps.num_residual_units):
       with tf.variable_scope('unit_1_%d' % i):
-        x = res_func(x, filters[1], filters[1], self._stride_arr(1), False)
+        x = self._residual_unit(0, res_func, x, filters[1], filters[1],
+                                self._stride_arr(1), False)
 
     with tf.variable_scope('unit_2_0'):
-      x = res_func(x, filters[1], filters[2], self._stride_arr(strides[1]),
-                   activate_before_residual[1])
+      x = self._residual_unit(1, res_func, x, filters[1], filters[2],
+                              self._stride_arr(strides[1]),
+                              activate_before_residual[1])
     for i in six.moves.range(1, self.hps.num_residual_units):
       with tf.variable_scope('unit_2_%d' % i):
-        x = res_func(x, filters[2], filters[2], self._stride_arr(1), False)
+        x = self._residual_unit(1, res_func, x, filters[2], filters[2],
+                                self._stride_arr(1), False)
 
     with tf.variable_scope('unit_3_0'):
-      x = res_func(x, filters[2], filters[3], self._stride_arr(strides[2]),
-                   activate_before_residual[2])
+      x = self._residual_unit(2, res_func, x, filters[2], filters[3],
+                              self._stride_arr(strides[2]),
+                              activate_before_residual[2])
     for i in six.moves.range(1, self.hps.num_residual_units):
       with tf.variable_scope('unit_3_%d' % i):
-        x = res_func(x, filters[3], filters[3], self._stride_arr(1), False)
+        x = self._residual_unit(2, res_func, x, filters[3], filters[3],
+                                self._stride_arr(1), False)
 
     with tf.variable_scope('unit_last'):
-      x = self._batch_norm('final_bn', x)
-      x = self._relu(x, self.hps.relu_leakiness)
+      x = self._bn_relu('final_bn', x)
       x = self._global_avg_pool(x)
 
     with tf.variable_scope('logit'):
@@ -133,7 +164,8 @@ class ResNet(object):
       xent = tf.nn.softmax_cross_entropy_with_logits(
           logits=logits, labels=self.labels)
       self.cost = tf.reduce_mean(xent, name='xent')
-      self.cost += self._decay()
+      if not self.hps.decoupled_decay:
+        self.cost += self._decay()
 
       tf.summary.scalar('cost', self.cost)
 
@@ -147,32 +179,49 @@ class ResNet(object):
     self.trainable_variables =  tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.hps.model_scope)
     self.grads = tf.gradients(self.cost, self.trainable_variables)
 
-    if self.hps.optimizer == 'sgd':
-      print("using sgd", self.lrn_rate)
-      optimizer = tf.train.GradientDescentOptimizer(self.lrn_rate)
-      apply_op = optimizer.apply_gradients(
-        zip(self.grads, self.trainable_variables),
-        global_step=self.global_step, name='train_step')
-    elif self.hps.optimizer == 'mom':
-      print("using mom", self.lrn_rate)
-      optimizer = tf.train.MomentumOptimizer(self.lrn_rate, 0.9)
-      apply_op = optimizer.apply_gradients(
-        zip(self.grads, self.trainable_variables),
-        global_step=self.global_step, name='train_step')
-    elif self.hps.optimizer == 'YF':
-      print("using YF")
-      self.optimizer = YFOptimizer()
-      apply_op = self.optimizer.apply_gradients(
-        zip(self.grads, self.trainable_variables) )
-    elif self.hps.optimizer == "adam":
-      print("using adam", self.lrn_rate)
-      optimizer = tf.train.AdamOptimizer(self.lrn_rate)
-      apply_op = optimizer.apply_gradients(
-        zip(self.grads, self.trainable_variables),
-        global_step=self.global_step, name='train_step')
-    else:
-      raise Exception("The specified optimizer is not supported")
+    # with decoupled weight decay the decay is applied together with the
+    # update instead of being part of the cost and gradients; it runs after
+    # the gradients are computed so they see the undecayed weights
+    decay_ops = []
+    if self.hps.decoupled_decay and self.hps.optimizer != 'YF':
+      with tf.control_dependencies(
+          [g for g in self.grads if g is not None]):
+        decay_ops = self._decoupled_decay_ops(self.lrn_rate)
+
+    with tf.control_dependencies(decay_ops):
+      if self.hps.optimizer == 'sgd':
+        print("using sgd", self.lrn_rate)
+        optimizer = tf.train.GradientDescentOptimizer(self.lrn_rate)
+        apply_op = optimizer.apply_gradients(
+          zip(self.grads, self.trainable_variables),
+          global_step=self.global_step, name='train_step')
+      elif self.hps.optimizer == 'mom':
+        print("using mom", self.lrn_rate)
+        optimizer = tf.train.MomentumOptimizer(self.lrn_rate, 0.9)
+        apply_op = optimizer.apply_gradients(
+          zip(self.grads, self.trainable_variables),
+          global_step=self.global_step, name='train_step')
+      elif self.hps.optimizer == 'YF':
+        print("using YF")
+        if self.hps.decoupled_decay:
+          self.optimizer = YFOptimizer(
+            weight_decay=self.hps.weight_decay_rate)
+        else:
+          self.optimizer = YFOptimizer()
+        apply_op = self.optimizer.apply_gradients(
+          zip(self.grads, self.trainable_variables),
+          decay_var_list=self._decay_vars)
+      elif self.hps.optimizer == "adam":
+        print("using adam", self.lrn_rate)
+        optimizer = tf.train.AdamOptimizer(self.lrn_rate)
+        apply_op = optimizer.apply_gradients(
+          zip(self.grads, self.trainable_variables),
+          global_step=self.global_step, name='train_step')
+      else:
+        raise Exception("The specified optimizer is not supported")
 
+    if self._bn_moving_stats:
+      self._extra_train_ops.append(self._moving_stats_update_op())
     train_ops = [apply_op] + self._extra_train_ops
     self.train_op = tf.group(*train_ops)
 
@@ -214,7 +263,7 @@ class ResNet(object):
   def _batch_norm(self, name, x):
     """Batch normalization."""
     with tf.variable_scope(name):
-      params_shape = [x.get_shape()[-1]]
+      params_shape = [self._num_channels(x)]
 
       beta = tf.get_variable(
           'beta', params_shape, tf.float32,
@@ -224,7 +273,11 @@ class ResNet(object):
           initializer=tf.constant_initializer(1.0, tf.float32))
 
       if self.mode == 'train':
-        mean, variance = tf.nn.moments(x, [0, 1, 2], name='moments')
+        if self.hps.data_format == 'NCHW':
+          moments_axes = [0, 2, 3]
+        else:
+          moments_axes = [0, 1, 2]
+        mean, variance = tf.nn.moments(x, moments_axes, name='moments')
 
         moving_mean = tf.get_variable(
             'moving_mean', params_shape, tf.float32,
@@ -235,10 +288,11 @@ class ResNet(object):
             initializer=tf.constant_initializer(1.0, tf.float32),
             trainable=False)
 
-        self._extra_train_ops.append(moving_averages.assign_moving_average(
-            moving_mean, mean, 0.9))
-        self._extra_train_ops.append(moving_averages.assign_moving_average(
-            moving_variance, variance, 0.9))
+        if not self._is_recomputing:
+          self._extra_train_ops.append(moving_averages.assign_moving_average(
+              moving_mean, mean, 0.9))
+          self._extra_train_ops.append(moving_averages.assign_moving_average(
+              moving_variance, variance, 0.9))
       else:
         mean = tf.get_variable(
             'moving_mean', params_shape, tf.float32,
@@ -250,40 +304,127 @@ class ResNet(object):
             trainable=False)
         tf.summary.histogram(mean.op.name, mean)
         tf.summary.histogram(variance.op.name, variance)
+      if self.hps.data_format == 'NCHW':
+        # broadcast the per channel parameters over [N, C, H, W]
+        mean, variance, beta, gamma = [
+            tf.reshape(t, [1, -1, 1, 1]) for t in (mean, variance, beta, gamma)]
       # elipson used to be 1e-5. Maybe 0.001 solves NaN problem in deeper net.
       y = tf.nn.batch_normalization(
           x, mean, variance, beta, gamma, 0.001)
       y.set_shape(x.get_shape())
       return y
 
+  def _fused_batch_norm(self, name, x):
+    """Batch normalization with the fused kernel.
+
+    Moments and normalization are computed by a single FusedBatchNorm op.
+    The moving statistics are not updated here; they are collected in
+    self._bn_moving_stats and updated by _moving_stats_update_op.
+    """
+    with tf.variable_scope(name):
+      params_shape = [self._num_channels(x)]
+
+      beta = tf.get_variable(
+          'beta', params_shape, tf.float32,
+          initializer=tf.constant_initializer(0.0, tf.float32))
+      gamma = tf.get_variable(
+          'gamma', params_shape, tf.float32,
+          initializer=tf.constant_initializer(1.0, tf.float32))
+      moving_mean = tf.get_variable(
+          'moving_mean', params_shape, tf.float32,
+          initializer=tf.constant_initializer(0.0, tf.float32),
+          trainable=False)
+      moving_variance = tf.get_variable(
+          'moving_variance', params_shape, tf.float32,
+          initializer=tf.constant_initializer(1.0, tf.float32),
+          trainable=False)
+
+      if self.mode == 'train':
+        y, mean, variance = tf.nn.fused_batch_norm(
+            x, gamma, beta, epsilon=0.001, data_format=self.hps.data_format,
+            is_training=True)
+        if not self._is_recomputing:
+          self._bn_moving_stats.append((moving_mean, mean))
+          self._bn_moving_stats.append((moving_variance, variance))
+      else:
+        y, _, _ = tf.nn.fused_batch_norm(
+            x, gamma, beta, mean=moving_mean, variance=moving_variance,
+            epsilon=0.001, data_format=self.hps.data_format,
+            is_training=False)
+        tf.summary.histogram(moving_mean.op.name, moving_mean)
+        tf.summary.histogram(moving_variance.op.name, moving_variance)
+      y.set_shape(x.get_shape())
+      return y
+
+  def _moving_stats_update_op(self):
+    """One grouped op updating all the batch norm moving statistics."""
+    with tf.name_scope('bn_moving_stats'):
+      updates = [
+          tf.assign_sub(var, (1.0 - BN_MOVING_AVG_DECAY) * (var - value))
+          for var, value in self._bn_moving_stats]
+      return tf.group(*updates)
+
+  def _bn_relu(self, name, x):
+    """Batch normalization followed by the (leaky) relu."""
+    if self.hps.fused_bn:
+      x = self._fused_batch_norm(name, x)
+    else:
+      x = self._batch_norm(name, x)
+    return self._relu(x, self.hps.relu_leakiness)
+
+  def _residual_unit(self, stage, res_func, x, *args):
+    """Residual unit, optionally recomputed during backprop.
+
+    With hps.recompute[stage] set, only the unit input is kept for the
+    backward pass and the activations inside the unit are recomputed from it.
+    Needs TensorFlow MIN_RECOMPUTE_TF_VERSION or later; the unit variables
+    are created as resource variables.
+    """
+    if self.mode != 'train' or not self.hps.recompute[stage]:
+      return res_func(x, *args)
+    if LooseVersion(tf.__version__) < LooseVersion(MIN_RECOMPUTE_TF_VERSION):
+      raise ValueError("recompute needs TensorFlow %s or later, found %s"
+                       % (MIN_RECOMPUTE_TF_VERSION, tf.__version__))
+
+    def unit_fn(unit_x, is_recomputing=False):
+      # the recomputation for the gradient must not register the moving
+      # stat updates and decay weights again
+      self._is_recomputing = is_recomputing
+      try:
+        return res_func(unit_x, *args)
+      finally:
+        self._is_recomputing = False
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+      return tf.contrib.layers.recompute_grad(unit_fn)(x)
+
   def _residual(self, x, in_filter, out_filter, stride,
                 activate_before_residual=False):
     """Residual unit with 2 sub layers."""
     if activate_before_residual:
       with tf.variable_scope('shared_activation'):
-        x = self._batch_norm('init_bn', x)
-        x = self._relu(x, self.hps.relu_leakiness)
+        x = self._bn_relu('init_bn', x)
         orig_x = x
     else:
       with tf.variable_scope('residual_only_activation'):
         orig_x = x
-        x = self._batch_norm('init_bn', x)
-        x = self._relu(x, self.hps.relu_leakiness)
+        x = self._bn_relu('init_bn', x)
 
     with tf.variable_scope('sub1'):
       x = self._conv('conv1', x, 3, in_filter, out_filter, stride)
 
     with tf.variable_scope('sub2'):
-      x = self._batch_norm('bn2', x)
-      x = self._relu(x, self.hps.relu_leakiness)
+      x = self._bn_relu('bn2', x)
       x = self._conv('conv2', x, 3, out_filter, out_filter, [1, 1, 1, 1])
 
     with tf.variable_scope('sub_add'):
       if in_filter != out_filter:
-        orig_x = tf.nn.avg_pool(orig_x, stride, stride, 'VALID')
-        orig_x = tf.pad(
-            orig_x, [[0, 0], [0, 0], [0, 0],
-                     [(out_filter-in_filter)//2, (out_filter-in_filter)//2]])
+        orig_x = tf.nn.avg_pool(orig_x, stride, stride, 'VALID',
+                                data_format=self.hps.data_format)
+        pad = [(out_filter-in_filter)//2, (out_filter-in_filter)//2]
+        if self.hps.data_format == 'NCHW':
+          orig_x = tf.pad(orig_x, [[0, 0], pad, [0, 0], [0, 0]])
+        else:
+          orig_x = tf.pad(orig_x, [[0, 0], [0, 0], [0, 0], pad])
       x += orig_x
 
     tf.logging.debug('image after unit %s', x.get_shape())
@@ -294,26 +435,22 @@ class ResNet(object):
     """Bottleneck residual unit with 3 sub layers."""
     if activate_before_residual:
       with tf.variable_scope('common_bn_relu'):
-        x = self._batch_norm('init_bn', x)
-        x = self._relu(x, self.hps.relu_leakiness)
+        x = self._bn_relu('init_bn', x)
         orig_x = x
     else:
       with tf.variable_scope('residual_bn_relu'):
         orig_x = x
-        x = self._batch_norm('init_bn', x)
-        x = self._relu(x, self.hps.relu_leakiness)
+        x = self._bn_relu('init_bn', x)
 
     with tf.variable_scope('sub1'):
       x = self._conv('conv1', x, 1, in_filter, out_filter/4, stride)
 
     with tf.variable_scope('sub2'):
-      x = self._batch_norm('bn2', x)
-      x = self._relu(x, self.hps.relu_leakiness)
+      x = self._bn_relu('bn2', x)
       x = self._conv('conv2', x, 3, out_filter/4, out_filter/4, [1, 1, 1, 1])
 
     with tf.variable_scope('sub3'):
-      x = self._batch_norm('bn3', x)
-      x = self._relu(x, self.hps.relu_leakiness)
+      x = self._bn_relu('bn3', x)
       x = self._conv('conv3', x, 1, out_filter/4, out_filter, [1, 1, 1, 1])
 
     with tf.variable_scope('sub_add'):
@@ -327,14 +464,26 @@ class ResNet(object):
   def _decay(self):
     """L2 weight decay loss."""
     costs = []
-    # for var in self.trainable_variables:
-    for var in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.hps.model_scope):
-      if var.op.name.find(r'DW') > 0:
-        costs.append(tf.nn.l2_loss(var))
-        # tf.summary.histogram(var.op.name, var)
+    for var in self._decay_vars:
+      costs.append(tf.nn.l2_loss(var))
+      # tf.summary.histogram(var.op.name, var)
 
     return tf.multiply(self.hps.weight_decay_rate, tf.add_n(costs))
 
+  def _decoupled_decay_ops(self, lrn_rate):
+    """Decoupled weight decay, var -= lrn_rate * weight_decay_rate * var."""
+    decay_ops = []
+    with tf.name_scope('decoupled_decay'):
+      for var in self._decay_vars:
+        decay_ops.append(tf.assign_sub(
+          var, lrn_rate * self.hps.weight_decay_rate * var))
+    return decay_ops
+
+  def _add_decay_var(self, var):
+    """Register a weight for weight decay, once per model."""
+    if not self._is_recomputing:
+      self._decay_vars.append(var)
+
   def _conv(self, name, x, filter_size, in_filters, out_filters, strides):
     """Convolution."""
     with tf.variable_scope(name):
@@ -343,11 +492,17 @@ class ResNet(object):
           'DW', [filter_size, filter_size, in_filters, out_filters],
           tf.float32, initializer=tf.random_normal_initializer(
               stddev=np.sqrt(2.0/n)))
-      return tf.nn.conv2d(x, kernel, strides, padding='SAME')
+      self._add_decay_var(kernel)
+      return tf.nn.conv2d(x, kernel, strides, padding='SAME',
+                          data_format=self.hps.data_format)
 
   def _relu(self, x, leakiness=0.0):
     """Relu, with optional leaky support."""
-    return tf.where(tf.less(x, 0.0), leakiness * x, x, name='leaky_relu')
+    # max(x, leakiness * x) is the leaky relu for 0 <= leakiness <= 1, and
+    # avoids materializing the boolean mask and both branches of tf.where
+    if leakiness == 0.0:
+      return tf.nn.relu(x, name='relu')
+    return tf.maximum(x, leakiness * x, name='leaky_relu')
 
   def _fully_connected(self, x, out_dim):
     """FullyConnected layer for final output."""
@@ -355,10 +510,13 @@ class ResNet(object):
     w = tf.get_variable(
         'DW', [x.get_shape()[1], out_dim],
         initializer=tf.uniform_unit_scaling_initializer(factor=1.0))
+    self._add_decay_var(w)
     b = tf.get_variable('biases', [out_dim],
                         initializer=tf.constant_initializer())
     return tf.nn.xw_plus_b(x, w, b)
 
   def _global_avg_pool(self, x):
     assert x.get_shape().ndims == 4
+    if self.hps.data_format == 'NCHW':
+      return tf.reduce_mean(x, [2, 3])
     return tf.reduce_mean(x, [1, 2])
@@ -0,0 +1,159 @@
+from __future__ import print_function
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../../tuner_utils'))
+import resnet_model
+from resnet_inference import InferenceResNet, export_inference_weights
+
+
+batch_size = 8
+
+
+def get_hps(**kwargs):
+  hps = resnet_model.HParams(batch_size=batch_size,
+                             num_classes=10,
+                             min_lrn_rate=0.0001,
+                             lrn_rate=0.1,
+                             mom=0.9,
+                             clip_norm_base=10.0,
+                             num_residual_units=2,
+                             use_bottleneck=False,
+                             weight_decay_rate=0.0002,
+                             relu_leakiness=0.1,
+                             optimizer='sgd',
+                             model_scope='train',
+                             h_max_log_smooth=True,
+                             fused_bn=False,
+                             recompute=(False, False, False),
+                             data_format='NHWC',
+                             decoupled_decay=False)
+  return hps._replace(**kwargs)
+
+
+def build_model(hps, name, images, labels, mode='train'):
+  with tf.variable_scope(name) as scope:
+    model = resnet_model.ResNet(hps._replace(model_scope=scope.name),
+                                images, labels, mode)
+    model.build_graph()
+  return model
+
+
+def random_inputs():
+  images = tf.constant(np.random.randn(
+    batch_size, 32, 32, 3).astype(np.float32))
+  labels = tf.one_hot(np.random.randint(10, size=batch_size), 10)
+  return images, labels
+
+
+def copy_variables_op(src_scope, dst_scope):
+  """Assign the trainable variables under dst_scope from the same named ones
+  under src_scope."""
+  src = dict((v.op.name[len(src_scope):], v) for v in tf.trainable_variables()
+             if v.op.name.startswith(src_scope + '/'))
+  return tf.group(*[tf.assign(v, src[v.op.name[len(dst_scope):]])
+                    for v in tf.trainable_variables()
+                    if v.op.name.startswith(dst_scope + '/')])
+
+
+def test_recompute_gradients():
+  images, labels = random_inputs()
+  plain = build_model(get_hps(), 'plain', images, labels)
+  recompute = build_model(get_hps(recompute=(True, True, True)), 'recompute',
+                          images, labels)
+  copy_op = copy_variables_op(plain.hps.model_scope,
+                              recompute.hps.model_scope)
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(copy_op)
+    plain_grads, recompute_grads = sess.run([plain.grads, recompute.grads])
+  assert len(plain_grads) == len(recompute_grads)
+  for var, g_plain, g_recompute in zip(
+      plain.trainable_variables, plain_grads, recompute_grads):
+    assert np.allclose(g_plain, g_recompute, rtol=1e-4, atol=1e-5), var.op.name
+  print("recompute gradient test passed!")
+
+
+def test_decoupled_decay_step():
+  lr = 0.1
+  wd = 0.5
+  images, labels = random_inputs()
+  model = build_model(get_hps(lrn_rate=lr, weight_decay_rate=wd,
+                              decoupled_decay=True), 'model', images, labels)
+  decay_vars = set(model._decay_vars)
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    w_vals, g_vals = sess.run([model.trainable_variables, model.grads])
+    sess.run(model.train_op)
+    w_new_vals = sess.run(model.trainable_variables)
+  for var, w, g, w_new in zip(
+      model.trainable_variables, w_vals, g_vals, w_new_vals):
+    if var in decay_vars:
+      target = w - lr * wd * w - lr * g
+    else:
+      target = w - lr * g
+    assert np.allclose(w_new, target, rtol=1e-4, atol=1e-6), var.op.name
+  print("decoupled weight decay step test passed!")
+
+
+def perturb_batch_norm_op(scope):
+  """Random non trivial batch norm parameters and moving statistics for the
+  variables under scope."""
+  assigns = []
+  for v in tf.global_variables():
+    if not v.op.name.startswith(scope + '/'):
+      continue
+    shape = v.get_shape()
+    if v.op.name.endswith('/moving_variance'):
+      assigns.append(tf.assign(v, tf.random_uniform(shape, 0.5, 2.0)))
+    elif v.op.name.endswith('/gamma'):
+      assigns.append(tf.assign(v, tf.random_uniform(shape, 0.5, 1.5)))
+    elif (v.op.name.endswith('/moving_mean')
+          or v.op.name.endswith('/beta')):
+      assigns.append(tf.assign(v, 0.1 * tf.random_normal(shape)))
+  return tf.group(*assigns)
+
+
+def check_inference_matches_eval(fused_bn):
+  images_val = np.random.uniform(
+    0, 255, [batch_size, 32, 32, 3]).astype(np.float32)
+  images = tf.placeholder(tf.float32, [batch_size, 32, 32, 3])
+  labels = tf.zeros([batch_size, 10])
+  model = build_model(
+    get_hps(fused_bn=fused_bn),
+    'fused_bn' if fused_bn else 'batch_norm',
+    tf.map_fn(tf.image.per_image_standardization, images), labels, 'eval')
+  perturb_op = perturb_batch_norm_op(model.hps.model_scope)
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(perturb_op)
+    eval_probs = sess.run(model.predictions, feed_dict={images: images_val})
+    bundle = export_inference_weights(sess, model.hps)
+  inference_model = InferenceResNet(model.hps, bundle)
+  inference_probs = inference_model.predict(images_val, batch_size=3)
+  inference_model.close()
+  assert np.allclose(eval_probs, inference_probs, rtol=1e-3, atol=1e-5)
+  print("inference test passed with fused_bn=%s!" % fused_bn)
+
+
+def test_inference_matches_eval():
+  check_inference_matches_eval(fused_bn=False)
+
+
+def test_inference_matches_eval_fused_bn():
+  check_inference_matches_eval(fused_bn=True)
+
+
+if __name__ == "__main__":
+  with tf.variable_scope("test_recompute_gradients"):
+    test_recompute_gradients()
+  with tf.variable_scope("test_decoupled_decay_step"):
+    test_decoupled_decay_step()
+  with tf.variable_scope("test_inference_matches_eval"):
+    test_inference_matches_eval()
+  with tf.variable_scope("test_inference_matches_eval_fused_bn"):
+    test_inference_matches_eval_fused_bn()
@@ -18,7 +18,7 @@ import matplotlib.pyplot as plt
 
 def get_model(hps, dataset, train_data_path, mode='train'):
   images, labels = cifar_input.build_input(
-    dataset, train_data_path, hps.batch_size, mode)
+    dataset, train_data_path, hps.batch_size, mode, hps.data_format)
   model = resnet_model.ResNet(hps, images, labels, mode)
   model.build_graph()
   return model
@@ -37,6 +37,57 @@ def setup(hps_train, hps_eval, gpu_mem_portion, DEV, DATASET, TRAIN_DATA_PATH, T
     return model_train, model_eval, init_op, mon_sess
 
 
+def select_data_format(dev, batch_size=128, n_iter=10, gpu_mem_portion=0.99):
+  """Pick the faster ResNet layout on dev with a microbenchmark.
+
+  Times the forward and backward pass of a 3x3 convolution, fused batch
+  norm and the 2x2 average pool of the projection shortcut in each layout.
+  Layouts the device has no kernel for, e.g. NCHW on most cpu builds, are
+  skipped. The session takes gpu_mem_portion of the gpu memory, as the
+  training session does, since the first session fixes the allocator.
+  Returns 'NHWC' or 'NCHW', NHWC when no layout runs.
+  """
+  config = tf.ConfigProto(
+    gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_mem_portion))
+  timing = {}
+  for data_format in ['NHWC', 'NCHW']:
+    if data_format == 'NCHW':
+      shape = [batch_size, 16, 32, 32]
+      pool_size = [1, 1, 2, 2]
+    else:
+      shape = [batch_size, 32, 32, 16]
+      pool_size = [1, 2, 2, 1]
+    with tf.Graph().as_default(), tf.device(dev):
+      x = tf.Variable(tf.random_normal(shape))
+      kernel = tf.Variable(tf.random_normal([3, 3, 16, 16]))
+      gamma = tf.Variable(tf.ones([16]))
+      beta = tf.Variable(tf.zeros([16]))
+      y = tf.nn.conv2d(x, kernel, [1, 1, 1, 1], padding='SAME',
+                       data_format=data_format)
+      y, _, _ = tf.nn.fused_batch_norm(y, gamma, beta, epsilon=0.001,
+                                       data_format=data_format)
+      y = tf.nn.avg_pool(y, pool_size, pool_size, 'VALID',
+                         data_format=data_format)
+      step = tf.group(*tf.gradients(tf.reduce_sum(y),
+                                    [x, kernel, gamma, beta]))
+      with tf.Session(config=config) as sess:
+        try:
+          sess.run(tf.global_variables_initializer())
+          sess.run(step)
+        except (tf.errors.InvalidArgumentError,
+                tf.errors.UnimplementedError):
+          print("no %s kernels on %s" % (data_format, dev))
+          continue
+        start_time = time.time()
+        for _ in range(n_iter):
+          sess.run(step)
+        timing[data_format] = (time.time() - start_time) / n_iter
+  print("conv, batch norm and pool time per layout ", timing)
+  if not timing:
+    return 'NHWC'
+  return min(timing, key=timing.get)
+
+
 def GetTrainingSession(model_train, n_core=16, gpu_mem_portion=0.99):
   mon_sess = tf.train.MonitoredTrainingSession(
     config=tf.ConfigProto(intra_op_parallelism_threads=n_core,
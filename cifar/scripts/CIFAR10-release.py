@@ -20,6 +20,7 @@ sys.path.append('../model')
 import resnet_model
 from resnet_utils import *
 import cifar_input
+from resnet_inference import export_inference_weights
 
 import argparse
 
@@ -30,8 +31,19 @@ parser.add_argument('--seed', type=int, default=1, help='random seed')
 parser.add_argument('--opt_method', type=str, default="YF", help='optimizer')
 parser.add_argument('--log_dir', type=str, default="results/", help="log folder")
 parser.add_argument('--h_max_log_smooth', action='store_true')
+parser.add_argument('--recompute', type=str, default='0,0,0',
+                    help='per stage flags to recompute the activations inside residual units during backprop, e.g. 0,1,1; needs TensorFlow 1.8 or later')
+parser.add_argument('--data_format', type=str, default='NHWC',
+                    help='NHWC, NCHW, or auto to pick the faster one on the device with a microbenchmark')
+parser.add_argument('--fused_bn', action='store_true',
+                    help='fused batch norm kernel; its moving variance is Bessel corrected, so results are not directly comparable to the published runs')
+parser.add_argument('--decoupled_decay', action='store_true',
+                    help='apply weight decay with the update instead of adding it to the loss')
+parser.add_argument('--export_path', type=str, default=None,
+                    help='.npz file to export the inference weights with folded batch norm to after training')
 
 args = parser.parse_args()
+recompute = tuple(bool(int(flag)) for flag in args.recompute.split(','))
 
 # set up path and other parameters
 NUM_CLASSES = 10
@@ -40,6 +52,13 @@ TEST_DATA_PATH = '../../data/cifar10/test_batch.bin'
 MODE = 'train'
 DATASET='cifar10'
 DEV = '/gpu:0'
+# specify how much memory to use on each GPU
+gpu_mem_portion=0.45
+if args.data_format == 'auto':
+  data_format = select_data_format(DEV, gpu_mem_portion=gpu_mem_portion)
+else:
+  data_format = args.data_format
+print("using data format", data_format)
 tf.reset_default_graph()
 
 # set random seed
@@ -63,7 +82,11 @@ hps_train = resnet_model.HParams(batch_size=batch_size_train,
                                 relu_leakiness=0.1,
                                 optimizer=args.opt_method,
                                 model_scope='train',
-                                h_max_log_smooth=args.h_max_log_smooth)
+                                h_max_log_smooth=args.h_max_log_smooth,
+                                fused_bn=args.fused_bn,
+                                recompute=recompute,
+                                data_format=data_format,
+                                decoupled_decay=args.decoupled_decay)
 hps_eval = resnet_model.HParams(batch_size=batch_size_test,
                                num_classes=NUM_CLASSES,
                                min_lrn_rate=0.0001,
@@ -76,10 +99,12 @@ hps_eval = resnet_model.HParams(batch_size=batch_size_test,
                                relu_leakiness=0.1,
                                optimizer=args.opt_method,
                                model_scope='train',
-                               h_max_log_smooth=args.h_max_log_smooth)
+                               h_max_log_smooth=args.h_max_log_smooth,
+                               fused_bn=args.fused_bn,
+                               recompute=recompute,
+                               data_format=data_format,
+                               decoupled_decay=args.decoupled_decay)
 
-# specify how much memory to use on each GPU
-gpu_mem_portion=0.45
 n_core = 16
 #with tf.variable_scope("train"), tf.device(DEV):
 #  model_train = get_model(hps_train, DATASET, TRAIN_DATA_PATH, mode='train')
@@ -128,3 +153,7 @@ for i in range(num_step):
 
     with open(log_dir + "/test_acc.txt", "w") as f:
         np.savetxt(f, np.array(precision_list) )
+
+if args.export_path is not None:
+  export_inference_weights(sess, hps_eval, args.export_path)
+  print("inference weights exported to", args.export_path)
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('../model')
+import resnet_model
+from resnet_utils import select_data_format
+from resnet_inference import InferenceResNet, export_inference_weights
+
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_size', type=int, default=128, help='batch size')
+parser.add_argument('--num_residual_units', type=int, default=5,
+                    help='residual units per stage')
+parser.add_argument('--use_bottleneck', action='store_true')
+parser.add_argument('--opt_method', type=str, default="YF", help='optimizer')
+parser.add_argument('--n_warmup', type=int, default=5, help='untimed steps')
+parser.add_argument('--n_step', type=int, default=20, help='timed steps')
+parser.add_argument('--n_core', type=int, default=16, help='cpu threads')
+parser.add_argument('--inference', action='store_true',
+                    help='time eval mode ResNet against the folded inference graph instead of train steps')
+parser.add_argument('--data_format', type=str, default='auto',
+                    help='NHWC, NCHW, or auto to pick the faster one on cpu')
+
+
+def get_hps(args, **kwargs):
+  hps = resnet_model.HParams(batch_size=args.batch_size,
+                             num_classes=10,
+                             min_lrn_rate=0.0001,
+                             lrn_rate=0.1,
+                             mom=0.9,
+                             clip_norm_base=10.0,
+                             num_residual_units=args.num_residual_units,
+                             use_bottleneck=args.use_bottleneck,
+                             weight_decay_rate=0.0002,
+                             relu_leakiness=0.1,
+                             optimizer=args.opt_method,
+                             model_scope='train',
+                             h_max_log_smooth=True,
+                             fused_bn=False,
+                             recompute=(False, False, False),
+                             data_format=args.data_format,
+                             decoupled_decay=False)
+  return hps._replace(**kwargs)
+
+
+def time_train_step(args, hps):
+  """Average seconds per train step on cpu, using random in-memory inputs."""
+  tf.reset_default_graph()
+  with tf.device('/cpu:0'):
+    if hps.data_format == 'NCHW':
+      images = tf.random_uniform([hps.batch_size, 3, 32, 32])
+    else:
+      images = tf.random_uniform([hps.batch_size, 32, 32, 3])
+    labels = tf.one_hot(tf.random_uniform(
+      [hps.batch_size], maxval=hps.num_classes, dtype=tf.int32),
+      hps.num_classes)
+    with tf.variable_scope('train'):
+      model = resnet_model.ResNet(hps, images, labels, 'train')
+      model.build_graph()
+  config = tf.ConfigProto(intra_op_parallelism_threads=args.n_core,
+                          inter_op_parallelism_threads=args.n_core)
+  with tf.Session(config=config) as sess:
+    sess.run(tf.global_variables_initializer())
+    for _ in range(args.n_warmup):
+      sess.run(model.train_op)
+    start = time.time()
+    for _ in range(args.n_step):
+      sess.run(model.train_op)
+    end = time.time()
+  return (end - start) / float(args.n_step)
+
+
+def time_inference(args, hps):
+  """Seconds per image of eval mode ResNet and of InferenceResNet on cpu."""
+  tf.reset_default_graph()
+  hps = hps._replace(data_format='NHWC')
+  images_val = np.random.uniform(
+    0, 255, [hps.batch_size, 32, 32, 3]).astype(np.float32)
+  with tf.device('/cpu:0'):
+    images = tf.placeholder(tf.float32, [hps.batch_size, 32, 32, 3])
+    labels = tf.zeros([hps.batch_size, hps.num_classes])
+    with tf.variable_scope('train'):
+      model = resnet_model.ResNet(
+        hps, tf.map_fn(tf.image.per_image_standardization, images), labels,
+        'eval')
+      model.build_graph()
+  config = tf.ConfigProto(intra_op_parallelism_threads=args.n_core,
+                          inter_op_parallelism_threads=args.n_core)
+  with tf.Session(config=config) as sess:
+    sess.run(tf.global_variables_initializer())
+    for _ in range(args.n_warmup):
+      sess.run(model.predictions, feed_dict={images: images_val})
+    start = time.time()
+    for _ in range(args.n_step):
+      sess.run(model.predictions, feed_dict={images: images_val})
+    eval_time = (time.time() - start) / float(args.n_step * hps.batch_size)
+    bundle = export_inference_weights(sess, hps)
+
+  inference_model = InferenceResNet(hps, bundle, n_core=args.n_core)
+  for _ in range(args.n_warmup):
+    inference_model.predict(images_val, hps.batch_size)
+  start = time.time()
+  for _ in range(args.n_step):
+    inference_model.predict(images_val, hps.batch_size)
+  inference_time = (time.time() - start) / float(args.n_step * hps.batch_size)
+  inference_model.close()
+  return eval_time, inference_time
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  if args.inference:
+    eval_time, inference_time = time_inference(
+      args, get_hps(args, fused_bn=True))
+    print("eval mode ResNet: %.6f s/image" % eval_time)
+    print("folded inference graph: %.6f s/image" % inference_time)
+    sys.exit(0)
+  if args.data_format == 'auto':
+    args.data_format = select_data_format('/cpu:0', args.batch_size)
+  print("using data format", args.data_format)
+  np.random.seed(1)
+  tf.set_random_seed(1)
+  for name, kwargs in [('tf.nn.moments + batch_normalization', {'fused_bn': False}),
+                       ('fused batch norm', {'fused_bn': True}),
+                       ('fused batch norm + recompute',
+                        {'fused_bn': True, 'recompute': (True, True, True)})]:
+    t = time_train_step(args, get_hps(args, **kwargs))
+    print("%s: %.4f s/step" % (name, t))
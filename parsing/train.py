@@ -31,6 +31,9 @@ flags.DEFINE_string('opt_method', None, 'opt_method')
 flags.DEFINE_string('log_dir', None, 'log_dir')
 flags.DEFINE_integer('seed', 1, 'seed')
 flags.DEFINE_integer('h_max_log_smooth', 0, 'use log smoothing for h_max')
+flags.DEFINE_string('rnn_mode', None, 'basic, dynamic or block')
+flags.DEFINE_integer('num_sampled', 0, 'sampled softmax classes, 0 for full')
+flags.DEFINE_integer('stateful', 0, 'keep the LSTM state in variables')
 
 FLAGS = flags.FLAGS
 
@@ -57,8 +60,14 @@ def train():
   if FLAGS.batch_size: config.batch_size = FLAGS.batch_size
   if FLAGS.opt_method: config.opt_method = FLAGS.opt_method
   if FLAGS.log_dir: config.log_dir = FLAGS.log_dir
+  if FLAGS.rnn_mode: config.rnn_mode = FLAGS.rnn_mode
+  if FLAGS.num_sampled: config.num_sampled = FLAGS.num_sampled
+  config.stateful = bool(FLAGS.stateful)
   config.h_max_log_smooth = FLAGS.h_max_log_smooth
   config.vocab_size = len(vocab)
+  if config.num_sampled:
+    config.unigram_counts = np.bincount(list(itertools.chain(*train_data)),
+                                        minlength=config.vocab_size)
   print('init_scale: %.2f' % config.init_scale)
   print('learning_rate: %.2f' % config.learning_rate)
   print('max_grad_norm: %.2f' % config.max_grad_norm)
@@ -73,6 +82,8 @@ def train():
   print('vocab_size: %d' % config.vocab_size)
   print('opt_method: %s' % config.opt_method)
   print('log_dir: %s' % config.log_dir)
+  print('rnn_mode: %s' % config.rnn_mode)
+  print('num_sampled: %d' % config.num_sampled)
   print('seed: %d' % FLAGS.seed)
   sys.stdout.flush()
   
@@ -91,6 +102,8 @@ def train():
   # eval_config.batch_size = config.batch_size
   eval_config.vocab_size = len(vocab)
   eval_config.h_max_log_smooth = config.h_max_log_smooth
+  eval_config.rnn_mode = config.rnn_mode
+  eval_config.stateful = config.stateful
 
   prev = 0
   with tf.Graph().as_default(), tf.Session() as session:
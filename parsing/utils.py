@@ -25,6 +25,43 @@ class MediumConfig(object):
   batch_size = 20
   opt_method = None
   log_dir = None
+  # basic: python unrolled cells, dynamic: tf.nn.dynamic_rnn,
+  # block: dynamic_rnn over the fused LSTMBlockCell
+  rnn_mode = "basic"
+  # > 0: sampled softmax over this many negative classes for training
+  num_sampled = 0
+  unigram_counts = None
+  # keep the LSTM state in local variables updated by the train op (or
+  # state_update) instead of feeding it back every step
+  stateful = False
+
+
+def _basic_lstm_cell_getter(getter, name, *args, **kwargs):
+  """Store the LSTMBlockCell weights under the BasicLSTMCell names, so
+  checkpoints are shared between the rnn modes."""
+  return getter(name.replace("/lstm_cell/", "/basic_lstm_cell/"),
+                *args, **kwargs)
+
+
+def _sampled_softmax_loss(output, softmax_w, softmax_b, targets, config):
+  """Per token sampled softmax loss of the training graph.
+
+  Negative classes are drawn from the unigram distribution of the training
+  data (config.unigram_counts, distorted by 0.75) when it is set, else from
+  the log uniform distribution, which fits the frequency sorted word ids.
+  """
+  labels = tf.reshape(targets, [-1, 1])
+  if getattr(config, "unigram_counts", None) is not None:
+    sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+        true_classes=labels, num_true=1, num_sampled=config.num_sampled,
+        unique=True, range_max=config.vocab_size, distortion=0.75,
+        unigrams=[max(int(c), 1) for c in config.unigram_counts])
+  else:
+    sampled_values = None
+  return tf.nn.sampled_softmax_loss(
+      weights=tf.transpose(softmax_w), biases=softmax_b, labels=labels,
+      inputs=output, num_sampled=config.num_sampled,
+      num_classes=config.vocab_size, sampled_values=sampled_values)
 
 
 class PTBModel(object):
@@ -49,6 +86,8 @@ class PTBModel(object):
     # initialized to 1 but the hyperparameters of the model would need to be
     # different than reported in the paper.
     def lstm_cell():
+      if config.rnn_mode == "block":
+        return tf.contrib.rnn.LSTMBlockCell(size, forget_bias=1.0)
       # With the latest TensorFlow source code (as of Mar 27, 2017),
       # the BasicLSTMCell will need a reuse parameter which is unfortunately not
       # defined in TensorFlow 1.0. To maintain backwards compatibility, we add
@@ -72,6 +111,20 @@ class PTBModel(object):
 
 
     self._initial_state = cell.zero_state(batch_size, tf.float32)
+    self._stateful = config.stateful
+    if self._stateful:
+      self._state_vars = [
+          tf.contrib.rnn.LSTMStateTuple(
+              tf.Variable(c, trainable=False, name="state_c_%d" % i,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES]),
+              tf.Variable(h, trainable=False, name="state_h_%d" % i,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES]))
+          for i, (c, h) in enumerate(self._initial_state)]
+      self._reset_state_op = tf.variables_initializer(
+          [v for state_var in self._state_vars for v in state_var])
+      self._initial_state = tuple(
+          tf.contrib.rnn.LSTMStateTuple(c.value(), h.value())
+          for c, h in self._state_vars)
 
     with tf.device("/cpu:0"):
       embedding = tf.get_variable("embedding", [vocab_size, size])
@@ -84,28 +137,44 @@ class PTBModel(object):
     #           for input_ in tf.split(inputs, num_steps, 1)]
     # outputs, state = tf.contrib.rnn.static_rnn(cell, inputs, initial_state=self._initial_state)
 
-    outputs = []
-    state = self._initial_state
-    with tf.variable_scope("RNN"):
-      for time_step in range(num_steps):
-        if time_step > 0: tf.get_variable_scope().reuse_variables()
-        (cell_output, state) = cell(inputs[:, time_step, :], state)
-        outputs.append(cell_output)
+    if config.rnn_mode == "basic":
+      outputs = []
+      state = self._initial_state
+      with tf.variable_scope("RNN"):
+        for time_step in range(num_steps):
+          if time_step > 0: tf.get_variable_scope().reuse_variables()
+          (cell_output, state) = cell(inputs[:, time_step, :], state)
+          outputs.append(cell_output)
 
-    output = tf.reshape(tf.stack(axis=1, values=outputs), [-1, size])
+      output = tf.reshape(tf.stack(axis=1, values=outputs), [-1, size])
+    else:
+      if config.rnn_mode == "block":
+        custom_getter = _basic_lstm_cell_getter
+      else:
+        custom_getter = None
+      with tf.variable_scope("RNN", custom_getter=custom_getter) as rnn_scope:
+        outputs, state = tf.nn.dynamic_rnn(
+            cell, inputs, initial_state=self._initial_state, scope=rnn_scope)
+      output = tf.reshape(outputs, [-1, size])
     softmax_w = tf.get_variable("softmax_w", [size, vocab_size])
     softmax_b = tf.get_variable("softmax_b", [vocab_size])
-    logits = tf.matmul(output, softmax_w) + softmax_b
-    loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(
-        [logits],
-        [tf.reshape(self._targets, [-1])],
-        [tf.ones([batch_size * num_steps])])
+    if is_training and config.num_sampled > 0:
+      loss = _sampled_softmax_loss(
+          output, softmax_w, softmax_b, self._targets, config)
+    else:
+      logits = tf.matmul(output, softmax_w) + softmax_b
+      loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(
+          [logits],
+          [tf.reshape(self._targets, [-1])],
+          [tf.ones([batch_size * num_steps])])
     cost = tf.reduce_sum(loss) / batch_size
     self._norm_loss = cost / num_steps
     self._cost = loss
     self._final_state = state
 
     if not is_training:
+      if self._stateful:
+        self._state_update = self._assign_state(state)
       return
 
     self._lr = tf.Variable(0.0, trainable=False)
@@ -132,6 +201,10 @@ class PTBModel(object):
       print("Optimizer is not supported")
 
     self._train_op = optimizer.apply_gradients(zip(grads, tvars))
+    if self._stateful:
+      # after the update, so the gradients still see the old state
+      with tf.control_dependencies([self._train_op]):
+        self._state_update = self._train_op = self._assign_state(state)
 
     self.train_loss_summary = tf.summary.scalar('train_loss', self._norm_loss)
 
@@ -139,6 +212,11 @@ class PTBModel(object):
         os.path.join(config.log_dir, time.strftime("%Y-%m-%d-%H-%M-%S")))
     # self.writer.add_graph(sess.graph)
 
+  def _assign_state(self, state):
+    return tf.group(*[tf.assign(v, value)
+                      for state_var, s in zip(self._state_vars, state)
+                      for v, value in zip(state_var, s)])
+
   def assign_lr(self, session, lr_value):
     session.run(tf.assign(self.lr, lr_value))
 
@@ -154,6 +232,18 @@ class PTBModel(object):
   def initial_state(self):
     return self._initial_state
 
+  @property
+  def stateful(self):
+    return self._stateful
+
+  @property
+  def reset_state_op(self):
+    return self._reset_state_op
+
+  @property
+  def state_update(self):
+    return self._state_update
+
   @property
   def cost(self):
     return self._cost
@@ -273,9 +363,12 @@ def run_epoch(session, m, data, eval_op, verbose=False, epoch_id=None):
   start_time = time.time()
   costs = 0.0
   iters = 0
-  state = []
-  for c, h in m.initial_state: # initial_state: ((c1, m1), (c2, m2))
-    state.append((c.eval(), h.eval()))
+  if m.stateful:
+    session.run(m.reset_state_op)
+  else:
+    state = []
+    for c, h in m.initial_state: # initial_state: ((c1, m1), (c2, m2))
+      state.append((c.eval(), h.eval()))
 
   loss_list = []
   for step, (x, y) in enumerate(ptb_iterator(data, m.batch_size,
@@ -283,9 +376,12 @@ def run_epoch(session, m, data, eval_op, verbose=False, epoch_id=None):
     fetches = []
     fetches.append(m.cost)
     fetches.append(eval_op)
-    for c, h in m.final_state: # final_state: ((c1, m1), (c2, m2))
-      fetches.append(c)
-      fetches.append(h)
+    if m.stateful:
+      fetches.append(m.state_update)
+    else:
+      for c, h in m.final_state: # final_state: ((c1, m1), (c2, m2))
+        fetches.append(c)
+        fetches.append(h)
     if verbose:
       fetches.append(m.train_loss_summary)
       fetches.append(m._norm_loss)
@@ -293,16 +389,18 @@ def run_epoch(session, m, data, eval_op, verbose=False, epoch_id=None):
     feed_dict = {}
     feed_dict[m.input_data] = x
     feed_dict[m.targets] = y
-    for i, (c, h) in enumerate(m.initial_state):
-      feed_dict[c], feed_dict[h] = state[i]
+    if not m.stateful:
+      for i, (c, h) in enumerate(m.initial_state):
+        feed_dict[c], feed_dict[h] = state[i]
 
     res = session.run(fetches, feed_dict)
     cost = res[0]
-    if verbose:
-      state_flat = res[2:-2] # [c1, m1, c2, m2]
-    else:
-      state_flat = res[2:] # [c1, m1, c2, m2]
-    state = [state_flat[i:i+2] for i in range(0, len(state_flat), 2)]
+    if not m.stateful:
+      if verbose:
+        state_flat = res[2:-2] # [c1, m1, c2, m2]
+      else:
+        state_flat = res[2:] # [c1, m1, c2, m2]
+      state = [state_flat[i:i+2] for i in range(0, len(state_flat), 2)]
     costs += np.sum(cost) / m.batch_size
     iters += m.num_steps
 
@@ -337,6 +435,9 @@ def run_epoch2(session, m, nbest, eval_op, eos, verbose=False):
   start_time = time.time()
   costs = 0.0
   iters = 0
+  if m.stateful:
+    # fed below like the non stateful model, only zero it once
+    session.run(m.reset_state_op)
   state = []
   for c, h in m.initial_state: # initial_state: ((c1, m1), (c2, m2))
     state.append((c.eval(), h.eval()))
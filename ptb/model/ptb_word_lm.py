@@ -40,6 +40,26 @@ The hyperparameters used in the model:
 - keep_prob - the probability of keeping weights in the dropout layer
 - lr_decay - the decay of the learning rate for each epoch after "max_epoch"
 - batch_size - the batch size
+- rnn_mode - "basic" for the python unrolled BasicLSTMCell, "dynamic" for
+  tf.nn.dynamic_rnn over the same cells, "block" for tf.nn.dynamic_rnn over
+  the fused LSTMBlockCell. All three share variable names and checkpoints.
+- num_sampled - if > 0, train on a sampled softmax over this many negative
+  classes instead of the full softmax. Evaluation always uses the full one.
+- stateful - keep the LSTM state between steps in local variables updated
+  by the train op (or state_update for eval), instead of fetching the final
+  state and feeding it back every step. reset_state_op zeroes it.
+- bptt_std - if > 0, train on windows of random length, num_steps on average
+  with this standard deviation, rounded to multiples of bptt_bucket. Needs
+  rnn_mode dynamic or block, one graph serves all the lengths.
+- sparse_embedding - look up each distinct id of a batch once and, with YF,
+  update only the touched embedding rows (YFOptimizer sparse_update). Run
+  sparse_flush_op before evaluating.
+- tie_embeddings - the softmax weights are the embedding rows.
+- softmax_rank - if > 0, factorize the output projection through this rank:
+  softmax_w becomes softmax_proj [hidden_size, rank] x softmax_w [rank,
+  vocab_size]. With tie_embeddings it factorizes the shared embedding
+  instead, as embedding [vocab_size, rank] x embedding_proj [rank,
+  hidden_size].
 
 The data required for this example is in the data/ dir of the
 PTB dataset from Tomas Mikolov's webpage:
@@ -78,8 +98,32 @@ flags.DEFINE_string("data_path", None,
                     "Where the training/test data is stored.")
 flags.DEFINE_string("save_path", None,
                     "Model output directory.")
+flags.DEFINE_string("cache_dir", None,
+                    "Directory for the token id cache of the data.")
 flags.DEFINE_bool("use_fp16", False,
                   "Train using 16-bit floats instead of 32bit floats")
+flags.DEFINE_string("rnn_mode", None,
+                    "Overrides the config rnn_mode: basic, dynamic or block.")
+flags.DEFINE_integer("num_sampled", 0,
+                     "Negative classes of the sampled softmax used for "
+                     "training, 0 for the full softmax.")
+flags.DEFINE_bool("stateful", False,
+                  "Keep the LSTM state in variables instead of feeding it.")
+flags.DEFINE_float("bptt_std", 0.0,
+                   "Std of the random training window length, 0 for fixed "
+                   "num_steps windows.")
+flags.DEFINE_integer("eval_streams", 0,
+                     "Evaluate the test set in this many parallel streams "
+                     "instead of one token per step, 0 to disable.")
+flags.DEFINE_integer("eval_steps", 35,
+                     "Unroll length of the multi stream test evaluation.")
+flags.DEFINE_bool("sparse_embedding", False,
+                  "Deduplicated embedding lookup and sparse YF update.")
+flags.DEFINE_bool("tie_embeddings", False,
+                  "Share the embedding with the softmax weights.")
+flags.DEFINE_integer("softmax_rank", 0,
+                     "Rank of the factorized softmax (or tied embedding), "
+                     "0 for full rank.")
 
 FLAGS = flags.FLAGS
 
@@ -88,6 +132,39 @@ def data_type():
   return tf.float16 if FLAGS.use_fp16 else tf.float32
 
 
+def _basic_lstm_cell_getter(getter, name, *args, **kwargs):
+  """Store the LSTMBlockCell weights under the BasicLSTMCell names.
+
+  Both cells use the same [input, h] x [i, j, f, o] weight layout, only the
+  cell scope differs, so this makes the rnn modes checkpoint compatible.
+  """
+  return getter(name.replace("/lstm_cell/", "/basic_lstm_cell/"),
+                *args, **kwargs)
+
+
+def _sampled_softmax_loss(output, softmax_w_rows, softmax_b, targets, config):
+  """Per token sampled softmax loss of the training graph.
+
+  softmax_w_rows holds the output weights as [vocab_size, dim] rows.
+
+  Negative classes are drawn from the unigram distribution of the training
+  data (config.unigram_counts, distorted by 0.75) when it is set, else from
+  the log uniform distribution, which fits the frequency sorted word ids.
+  """
+  labels = tf.reshape(targets, [-1, 1])
+  if getattr(config, "unigram_counts", None) is not None:
+    sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+        true_classes=labels, num_true=1, num_sampled=config.num_sampled,
+        unique=True, range_max=config.vocab_size, distortion=0.75,
+        unigrams=[max(int(c), 1) for c in config.unigram_counts])
+  else:
+    sampled_values = None
+  return tf.nn.sampled_softmax_loss(
+      weights=softmax_w_rows, biases=softmax_b, labels=labels,
+      inputs=output, num_sampled=config.num_sampled,
+      num_classes=config.vocab_size, sampled_values=sampled_values)
+
+
 class PTBInput(object):
   """The input data."""
 
@@ -99,6 +176,71 @@ class PTBInput(object):
         data, batch_size, num_steps, name=name)
 
 
+class PTBFeedInput(object):
+  """Input fed batch by batch, in windows of random length.
+
+  Stands in for PTBInput when training with a variable truncated BPTT
+  length: num_steps is None and the model reads the window length from the
+  fed arrays.
+  """
+
+  def __init__(self, config, data, name=None):
+    self.batch_size = batch_size = config.batch_size
+    self.num_steps = None
+    self.mean_steps = config.num_steps
+    self.std_steps = config.bptt_std
+    self.bucket_width = config.bptt_bucket
+    self.data = data
+    with tf.name_scope(name, "PTBFeedInput"):
+      self.input_data = tf.placeholder(tf.int32, [batch_size, None],
+                                       name="input_data")
+      self.targets = tf.placeholder(tf.int32, [batch_size, None],
+                                    name="targets")
+
+  def batches(self, rng=None):
+    return reader.ptb_bptt_iterator(
+        self.data, self.batch_size, self.mean_steps, self.std_steps,
+        bucket_width=self.bucket_width, rng=rng)
+
+
+class PTBStreamInput(object):
+  """Input for scoring a whole data set in batch_size parallel streams.
+
+  The data is cut into batch_size contiguous streams, scored num_steps
+  tokens at a time by run_stream_eval. windows() pads the end of the last
+  stream and weighs the padding out, so every token is scored exactly once.
+  """
+
+  def __init__(self, config, data, name=None):
+    self.batch_size = batch_size = config.batch_size
+    self.num_steps = num_steps = config.num_steps
+    self.data = data
+    with tf.name_scope(name, "PTBStreamInput"):
+      self.input_data = tf.placeholder(tf.int32, [batch_size, num_steps],
+                                       name="input_data")
+      self.targets = tf.placeholder(tf.int32, [batch_size, num_steps],
+                                    name="targets")
+
+  def windows(self):
+    """Yields (x, y, weights), each [batch_size, num_steps], weights being
+    0 on padding and 1 on the len(data) - 1 scored tokens."""
+    data = np.asarray(self.data, dtype=np.int32)
+    n_token = data.size - 1
+    stream_len = -(-n_token // self.batch_size)
+    stream_len = -(-stream_len // self.num_steps) * self.num_steps
+    x = np.zeros([self.batch_size * stream_len], dtype=np.int32)
+    y = np.zeros([self.batch_size * stream_len], dtype=np.int32)
+    weights = np.zeros([self.batch_size * stream_len], dtype=np.float32)
+    x[:n_token] = data[:-1]
+    y[:n_token] = data[1:]
+    weights[:n_token] = 1.0
+    shape = [self.batch_size, stream_len]
+    x, y, weights = x.reshape(shape), y.reshape(shape), weights.reshape(shape)
+    for i in range(0, stream_len, self.num_steps):
+      window = slice(i, i + self.num_steps)
+      yield x[:, window], y[:, window], weights[:, window]
+
+
 class PTBModel(object):
   """The PTB model."""
 
@@ -109,11 +251,21 @@ class PTBModel(object):
     num_steps = input_.num_steps
     size = config.hidden_size
     vocab_size = config.vocab_size
+    if num_steps is None:
+      if config.rnn_mode == "basic":
+        raise ValueError("variable length windows need rnn_mode dynamic "
+                         "or block")
+      num_steps = tf.shape(input_.input_data)[1]
+      num_tokens = tf.cast(batch_size * num_steps, data_type())
+    else:
+      num_tokens = batch_size * num_steps
 
     # Slightly better results can be obtained with forget gate biases
     # initialized to 1 but the hyperparameters of the model would need to be
     # different than reported in the paper.
     def lstm_cell():
+      if config.rnn_mode == "block":
+        return tf.contrib.rnn.LSTMBlockCell(size, forget_bias=0.0)
       # With the latest TensorFlow source code (as of Mar 27, 2017),
       # the BasicLSTMCell will need a reuse parameter which is unfortunately not
       # defined in TensorFlow 1.0. To maintain backwards compatibility, we add
@@ -135,11 +287,50 @@ class PTBModel(object):
         [attn_cell() for _ in range(config.num_layers)], state_is_tuple=True)
 
     self._initial_state = cell.zero_state(batch_size, data_type())
-
-    with tf.device("cpu:0"):
+    self._stateful = config.stateful
+    if self._stateful:
+      self._state_vars = [
+          tf.contrib.rnn.LSTMStateTuple(
+              tf.Variable(c, trainable=False, name="state_c_%d" % i,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES]),
+              tf.Variable(h, trainable=False, name="state_h_%d" % i,
+                          collections=[tf.GraphKeys.LOCAL_VARIABLES]))
+          for i, (c, h) in enumerate(self._initial_state)]
+      self._reset_state_op = tf.variables_initializer(
+          [v for state_var in self._state_vars for v in state_var])
+      self._initial_state = tuple(
+          tf.contrib.rnn.LSTMStateTuple(c.value(), h.value())
+          for c, h in self._state_vars)
+
+    # a tied embedding is factorized instead of the softmax
+    if config.tie_embeddings and config.softmax_rank > 0:
+      embedding_size = config.softmax_rank
+    else:
+      embedding_size = size
+    if config.sparse_embedding:
+      # only the distinct ids of the batch are gathered, and the gradient
+      # has one row per distinct id, so no need to keep it on the cpu
       embedding = tf.get_variable(
-          "embedding", [vocab_size, size], dtype=data_type())
+          "embedding", [vocab_size, embedding_size], dtype=data_type())
+      ids, positions = tf.unique(tf.reshape(input_.input_data, [-1]))
+      inputs = tf.reshape(tf.gather(tf.gather(embedding, ids), positions),
+                          [batch_size, num_steps, embedding_size])
+    elif config.tie_embeddings:
+      # also the softmax weights, so it stays next to the model
+      embedding = tf.get_variable(
+          "embedding", [vocab_size, embedding_size], dtype=data_type())
       inputs = tf.nn.embedding_lookup(embedding, input_.input_data)
+    else:
+      with tf.device("cpu:0"):
+        embedding = tf.get_variable(
+            "embedding", [vocab_size, size], dtype=data_type())
+        inputs = tf.nn.embedding_lookup(embedding, input_.input_data)
+    if embedding_size != size:
+      embedding_proj = tf.get_variable(
+          "embedding_proj", [embedding_size, size], dtype=data_type())
+      inputs = tf.reshape(
+          tf.matmul(tf.reshape(inputs, [-1, embedding_size]), embedding_proj),
+          [batch_size, num_steps, size])
 
     if is_training and config.keep_prob < 1:
       inputs = tf.nn.dropout(inputs, config.keep_prob)
@@ -152,29 +343,64 @@ class PTBModel(object):
     #
     # inputs = tf.unstack(inputs, num=num_steps, axis=1)
     # outputs, state = tf.nn.rnn(cell, inputs, initial_state=self._initial_state)
-    outputs = []
-    state = self._initial_state
-    with tf.variable_scope("RNN"):
-      for time_step in range(num_steps):
-        if time_step > 0: tf.get_variable_scope().reuse_variables()
-        (cell_output, state) = cell(inputs[:, time_step, :], state)
-        outputs.append(cell_output)
-
-    output = tf.reshape(tf.stack(axis=1, values=outputs), [-1, size])
-    softmax_w = tf.get_variable(
-        "softmax_w", [size, vocab_size], dtype=data_type())
+    if config.rnn_mode == "basic":
+      outputs = []
+      state = self._initial_state
+      with tf.variable_scope("RNN"):
+        for time_step in range(num_steps):
+          if time_step > 0: tf.get_variable_scope().reuse_variables()
+          (cell_output, state) = cell(inputs[:, time_step, :], state)
+          outputs.append(cell_output)
+
+      output = tf.reshape(tf.stack(axis=1, values=outputs), [-1, size])
+    else:
+      # One copy of the cell in a while loop instead of num_steps copies.
+      if config.rnn_mode == "block":
+        custom_getter = _basic_lstm_cell_getter
+      else:
+        custom_getter = None
+      with tf.variable_scope("RNN", custom_getter=custom_getter) as rnn_scope:
+        outputs, state = tf.nn.dynamic_rnn(
+            cell, inputs, initial_state=self._initial_state, scope=rnn_scope)
+      output = tf.reshape(outputs, [-1, size])
+    if config.tie_embeddings:
+      if embedding_size != size:
+        output = tf.matmul(output, embedding_proj, transpose_b=True)
+    elif config.softmax_rank > 0:
+      softmax_proj = tf.get_variable(
+          "softmax_proj", [size, config.softmax_rank], dtype=data_type())
+      output = tf.matmul(output, softmax_proj)
+      softmax_w = tf.get_variable(
+          "softmax_w", [config.softmax_rank, vocab_size], dtype=data_type())
+    else:
+      softmax_w = tf.get_variable(
+          "softmax_w", [size, vocab_size], dtype=data_type())
     softmax_b = tf.get_variable("softmax_b", [vocab_size], dtype=data_type())
     
-    logits = tf.matmul(output, softmax_w) + softmax_b
-    loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(
-        [logits],
-        [tf.reshape(input_.targets, [-1])],
-        [tf.ones([batch_size * num_steps], dtype=data_type())])
+    if is_training and config.num_sampled > 0:
+      if config.tie_embeddings:
+        softmax_w_rows = embedding
+      else:
+        softmax_w_rows = tf.transpose(softmax_w)
+      loss = _sampled_softmax_loss(
+          output, softmax_w_rows, softmax_b, input_.targets, config)
+    else:
+      if config.tie_embeddings:
+        logits = tf.matmul(output, embedding, transpose_b=True) + softmax_b
+      else:
+        logits = tf.matmul(output, softmax_w) + softmax_b
+      loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(
+          [logits],
+          [tf.reshape(input_.targets, [-1])],
+          [tf.ones([batch_size * num_steps], dtype=data_type())])
     # self._cost = cost = tf.reduce_sum(loss) / batch_size
-    self._cost = cost = tf.reduce_sum(loss) / (batch_size * num_steps)
+    self._cost = cost = tf.reduce_sum(loss) / num_tokens
     self._final_state = state
+    self._token_loss = tf.reshape(loss, [batch_size, -1])
 
     if not is_training:
+      if self._stateful:
+        self._state_update = self._assign_state(state)
       return
 
     self._lr = tf.Variable(0.0, trainable=False)
@@ -207,7 +433,8 @@ class PTBModel(object):
       print("using YF")
       #optimizer = YFOptimizer(learning_rate=1.0, momentum=0.0)
       #print("h max log smooth", config.h_max_log_smooth)
-      self.optimizer = optimizer = YFOptimizer()
+      self.optimizer = optimizer = YFOptimizer(
+          sparse_update=config.sparse_embedding)
       self._train_op = optimizer.apply_gradients(zip(self.grads, tvars) )
     elif opt_method == "adagrad":
       print("using adagrad")
@@ -217,6 +444,16 @@ class PTBModel(object):
     else:
       raise Exception("optimizer not supported")
 
+    if opt_method == 'YF':
+      self._sparse_flush_op = optimizer.sparse_flush_op()
+    else:
+      self._sparse_flush_op = tf.no_op()
+
+    if self._stateful:
+      # after the update, so the gradients still see the old state
+      with tf.control_dependencies([self._train_op]):
+        self._state_update = self._train_op = self._assign_state(state)
+
     self._new_lr = tf.placeholder(
         tf.float32, shape=[], name="new_learning_rate")
     self._lr_update = tf.assign(self._lr, self._new_lr)
@@ -230,6 +467,11 @@ class PTBModel(object):
     self._grad_norm_thresh_update = tf.assign(self._grad_norm_thresh, self._new_grad_norm_thresh)
 
 
+  def _assign_state(self, state):
+    return tf.group(*[tf.assign(v, value)
+                      for state_var, s in zip(self._state_vars, state)
+                      for v, value in zip(state_var, s)])
+
   def assign_lr(self, session, lr_value):
     session.run(self._lr_update, feed_dict={self._new_lr: lr_value})
 
@@ -247,10 +489,26 @@ class PTBModel(object):
   def initial_state(self):
     return self._initial_state
 
+  @property
+  def stateful(self):
+    return self._stateful
+
+  @property
+  def reset_state_op(self):
+    return self._reset_state_op
+
+  @property
+  def state_update(self):
+    return self._state_update
+
   @property
   def cost(self):
     return self._cost
 
+  @property
+  def token_loss(self):
+    return self._token_loss
+
   @property
   def final_state(self):
     return self._final_state
@@ -263,6 +521,10 @@ class PTBModel(object):
   def train_op(self):
     return self._train_op
 
+  @property
+  def sparse_flush_op(self):
+    return self._sparse_flush_op
+
 
 class SmallConfig(object):
   """Small config."""
@@ -278,6 +540,14 @@ class SmallConfig(object):
   lr_decay = 0.5
   batch_size = 20
   vocab_size = 10000
+  rnn_mode = "basic"
+  num_sampled = 0
+  stateful = False
+  bptt_std = 0.0
+  bptt_bucket = 5
+  sparse_embedding = False
+  tie_embeddings = False
+  softmax_rank = 0
 
 
 class MediumConfig(object):
@@ -294,6 +564,14 @@ class MediumConfig(object):
   lr_decay = 0.8
   batch_size = 20
   vocab_size = 10000
+  rnn_mode = "basic"
+  num_sampled = 0
+  stateful = False
+  bptt_std = 0.0
+  bptt_bucket = 5
+  sparse_embedding = False
+  tie_embeddings = False
+  softmax_rank = 0
 
 
 class LargeConfig(object):
@@ -310,6 +588,14 @@ class LargeConfig(object):
   lr_decay = 1 / 1.15
   batch_size = 20
   vocab_size = 10000
+  rnn_mode = "basic"
+  num_sampled = 0
+  stateful = False
+  bptt_std = 0.0
+  bptt_bucket = 5
+  sparse_embedding = False
+  tie_embeddings = False
+  softmax_rank = 0
 
 
 class TestConfig(object):
@@ -326,6 +612,14 @@ class TestConfig(object):
   lr_decay = 0.5
   batch_size = 20
   vocab_size = 10000
+  rnn_mode = "basic"
+  num_sampled = 0
+  stateful = False
+  bptt_std = 0.0
+  bptt_bucket = 5
+  sparse_embedding = False
+  tie_embeddings = False
+  softmax_rank = 0
 
 
 def run_epoch(session, model, eval_op=None, verbose=False):
@@ -333,23 +627,31 @@ def run_epoch(session, model, eval_op=None, verbose=False):
   start_time = time.time()
   costs = 0.0
   iters = 0
-  state = session.run(model.initial_state)
-
-  fetches = {
-      "cost": model.cost,
-      "final_state": model.final_state,
-  }
+  if model.stateful:
+    session.run(model.reset_state_op)
+    fetches = {
+        "cost": model.cost,
+        "state_update": model.state_update,
+    }
+  else:
+    state = session.run(model.initial_state)
+    fetches = {
+        "cost": model.cost,
+        "final_state": model.final_state,
+    }
   if eval_op is not None:
     fetches["eval_op"] = eval_op
 
   for step in range(model.input.epoch_size):
     feed_dict = {}
-    for i, (c, h) in enumerate(model.initial_state):
-      feed_dict[c] = state[i].c
-      feed_dict[h] = state[i].h
+    if not model.stateful:
+      for i, (c, h) in enumerate(model.initial_state):
+        feed_dict[c] = state[i].c
+        feed_dict[h] = state[i].h
     vals = session.run(fetches, feed_dict)
     cost = vals["cost"]
-    state = vals["final_state"]
+    if not model.stateful:
+      state = vals["final_state"]
 
     costs += cost
     iters += model.input.num_steps
@@ -362,6 +664,86 @@ def run_epoch(session, model, eval_op=None, verbose=False):
   return np.exp(costs * model.input.num_steps / iters)
 
 
+def run_bptt_epoch(session, model, eval_op=None, verbose=False, rng=None):
+  """Runs the model on the random length windows of its PTBFeedInput."""
+  start_time = time.time()
+  costs = 0.0
+  iters = 0
+  if model.stateful:
+    session.run(model.reset_state_op)
+    fetches = {
+        "cost": model.cost,
+        "state_update": model.state_update,
+    }
+  else:
+    state = session.run(model.initial_state)
+    fetches = {
+        "cost": model.cost,
+        "final_state": model.final_state,
+    }
+  if eval_op is not None:
+    fetches["eval_op"] = eval_op
+
+  epoch_len = len(model.input.data) // model.input.batch_size
+  for step, (x, y) in enumerate(model.input.batches(rng)):
+    feed_dict = {model.input.input_data: x, model.input.targets: y}
+    if not model.stateful:
+      for i, (c, h) in enumerate(model.initial_state):
+        feed_dict[c] = state[i].c
+        feed_dict[h] = state[i].h
+    vals = session.run(fetches, feed_dict)
+    if not model.stateful:
+      state = vals["final_state"]
+
+    # the cost is per token, weight it by the window length
+    costs += vals["cost"] * x.shape[1]
+    iters += x.shape[1]
+
+    if verbose and step % 100 == 10:
+      print("%.3f perplexity: %.3f speed: %.0f wps" %
+            (iters * 1.0 / epoch_len, np.exp(costs / iters),
+             iters * model.input.batch_size / (time.time() - start_time)))
+
+  return np.exp(costs / iters)
+
+
+def run_stream_eval(session, model):
+  """Exact perplexity of the data of a model on a PTBStreamInput.
+
+  Each stream starts from the zero state and carries its own state over
+  the windows. The per token losses of all streams are summed, padding
+  weighed out, and normalized by the number of scored tokens.
+  """
+  if model.stateful:
+    session.run(model.reset_state_op)
+    fetches = {
+        "token_loss": model.token_loss,
+        "state_update": model.state_update,
+    }
+  else:
+    state = session.run(model.initial_state)
+    fetches = {
+        "token_loss": model.token_loss,
+        "final_state": model.final_state,
+    }
+
+  loss_sum = 0.0
+  n_token = 0.0
+  for x, y, weights in model.input.windows():
+    feed_dict = {model.input.input_data: x, model.input.targets: y}
+    if not model.stateful:
+      for i, (c, h) in enumerate(model.initial_state):
+        feed_dict[c] = state[i].c
+        feed_dict[h] = state[i].h
+    vals = session.run(fetches, feed_dict)
+    if not model.stateful:
+      state = vals["final_state"]
+    loss_sum += np.sum(vals["token_loss"] * weights)
+    n_token += np.sum(weights)
+
+  return np.exp(loss_sum / n_token)
+
+
 def get_config():
   if FLAGS.model == "small":
     return SmallConfig()
@@ -379,20 +761,45 @@ def main(_):
   if not FLAGS.data_path:
     raise ValueError("Must set --data_path to PTB data directory")
 
-  raw_data = reader.ptb_raw_data(FLAGS.data_path)
+  raw_data = reader.ptb_raw_data(FLAGS.data_path, cache_dir=FLAGS.cache_dir)
   train_data, valid_data, test_data, _ = raw_data
 
   config = get_config()
   eval_config = get_config()
-  eval_config.batch_size = 1
-  eval_config.num_steps = 1
+  if FLAGS.rnn_mode:
+    config.rnn_mode = eval_config.rnn_mode = FLAGS.rnn_mode
+  if FLAGS.stateful:
+    config.stateful = eval_config.stateful = True
+  if FLAGS.bptt_std > 0:
+    config.bptt_std = FLAGS.bptt_std
+  if FLAGS.sparse_embedding:
+    config.sparse_embedding = eval_config.sparse_embedding = True
+  if FLAGS.tie_embeddings:
+    config.tie_embeddings = eval_config.tie_embeddings = True
+  if FLAGS.softmax_rank > 0:
+    config.softmax_rank = eval_config.softmax_rank = FLAGS.softmax_rank
+  if FLAGS.num_sampled:
+    config.num_sampled = FLAGS.num_sampled
+    config.unigram_counts = np.bincount(train_data,
+                                        minlength=config.vocab_size)
+  if FLAGS.eval_streams > 0:
+    eval_config.batch_size = FLAGS.eval_streams
+    eval_config.num_steps = FLAGS.eval_steps
+  else:
+    eval_config.batch_size = 1
+    eval_config.num_steps = 1
 
   with tf.Graph().as_default():
     initializer = tf.random_uniform_initializer(-config.init_scale,
                                                 config.init_scale)
 
     with tf.name_scope("Train"):
-      train_input = PTBInput(config=config, data=train_data, name="TrainInput")
+      if config.bptt_std > 0:
+        train_input = PTBFeedInput(config=config, data=train_data,
+                                   name="TrainInput")
+      else:
+        train_input = PTBInput(config=config, data=train_data,
+                               name="TrainInput")
       with tf.variable_scope("Model", reuse=None, initializer=initializer):
         m = PTBModel(is_training=True, config=config, input_=train_input)
       tf.scalar_summary("Training Loss", m.cost)
@@ -405,7 +812,12 @@ def main(_):
       tf.scalar_summary("Validation Loss", mvalid.cost)
 
     with tf.name_scope("Test"):
-      test_input = PTBInput(config=eval_config, data=test_data, name="TestInput")
+      if FLAGS.eval_streams > 0:
+        test_input = PTBStreamInput(config=eval_config, data=test_data,
+                                    name="TestInput")
+      else:
+        test_input = PTBInput(config=eval_config, data=test_data,
+                              name="TestInput")
       with tf.variable_scope("Model", reuse=True, initializer=initializer):
         mtest = PTBModel(is_training=False, config=eval_config,
                          input_=test_input)
@@ -414,18 +826,27 @@ def main(_):
     with sv.managed_session() as session:
     # session = sv.managed_session()
     # with tf.Session() as session:
+      reader.initialize_data(session)
       for i in range(config.max_max_epoch):
         lr_decay = config.lr_decay ** max(i + 1 - config.max_epoch, 0.0)
         m.assign_lr(session, config.learning_rate * lr_decay)
 
         print("Epoch: %d Learning rate: %.3f" % (i + 1, session.run(m.lr)))
-        train_perplexity = run_epoch(session, m, eval_op=m.train_op,
-                                     verbose=True)
+        if config.bptt_std > 0:
+          train_perplexity = run_bptt_epoch(session, m, eval_op=m.train_op,
+                                            verbose=True)
+        else:
+          train_perplexity = run_epoch(session, m, eval_op=m.train_op,
+                                       verbose=True)
         print("Epoch: %d Train Perplexity: %.3f" % (i + 1, train_perplexity))
+        session.run(m.sparse_flush_op)
         valid_perplexity = run_epoch(session, mvalid)
         print("Epoch: %d Valid Perplexity: %.3f" % (i + 1, valid_perplexity))
 
-      test_perplexity = run_epoch(session, mtest)
+      if FLAGS.eval_streams > 0:
+        test_perplexity = run_stream_eval(session, mtest)
+      else:
+        test_perplexity = run_epoch(session, mtest)
       print("Test Perplexity: %.3f" % test_perplexity)
 
       if FLAGS.save_path:
@@ -20,8 +20,13 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
+import io
 import os
+import shutil
+import weakref
 
+import numpy as np
 import tensorflow as tf
 
 
@@ -30,24 +35,69 @@ def _read_words(filename):
     return f.read().decode("utf-8").replace("\n", "<eos>").split()
 
 
-def _build_vocab(filename):
-  data = _read_words(filename)
-
+def _count_words(data):
+  """Words sorted by decreasing count, with their counts."""
   counter = collections.Counter(data)
   count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
+  words, counts = list(zip(*count_pairs))
+  return words, counts
+
+
+def _words_to_ids(data, word_to_id):
+  return np.array([word_to_id[word] for word in data if word in word_to_id],
+                  dtype=np.int32)
 
-  words, _ = list(zip(*count_pairs))
-  word_to_id = dict(zip(words, range(len(words))))
 
-  return word_to_id
+def _files_hash(filenames):
+  """sha1 over the contents of filenames, the key of the token id cache."""
+  sha = hashlib.sha1()
+  for filename in filenames:
+    with tf.gfile.GFile(filename, "rb") as f:
+      while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+          break
+        sha.update(chunk)
+  return sha.hexdigest()
 
 
-def _file_to_word_ids(filename, word_to_id):
-  data = _read_words(filename)
-  return [word_to_id[word] for word in data if word in word_to_id]
+_CACHE_PARTS = ["train", "valid", "test"]
 
 
-def ptb_raw_data(data_path=None):
+def _write_cache(cache_path, words, counts, id_arrays):
+  """Write the vocabulary and token id arrays, then move them in place.
+
+  The arrays are written to a temporary directory that is renamed to
+  cache_path at the end, so an interrupted run never leaves a partial cache.
+  """
+  tmp_path = "%s.tmp%d" % (cache_path, os.getpid())
+  if os.path.isdir(tmp_path):
+    shutil.rmtree(tmp_path)
+  os.makedirs(tmp_path)
+  with io.open(os.path.join(tmp_path, "vocab.txt"), "w",
+               encoding="utf-8") as f:
+    for word in words:
+      f.write(u"%s\n" % word)
+  np.save(os.path.join(tmp_path, "counts.npy"),
+          np.array(counts, dtype=np.int64))
+  for part, ids in zip(_CACHE_PARTS, id_arrays):
+    np.save(os.path.join(tmp_path, part + ".npy"), ids)
+  try:
+    os.rename(tmp_path, cache_path)
+  except OSError:
+    # another run built the same cache first
+    shutil.rmtree(tmp_path)
+
+
+def _load_cache(cache_path):
+  """Memory map the token id arrays of a cache written by _write_cache."""
+  id_arrays = [np.load(os.path.join(cache_path, part + ".npy"), mmap_mode="r")
+               for part in _CACHE_PARTS]
+  counts = np.load(os.path.join(cache_path, "counts.npy"))
+  return id_arrays, len(counts)
+
+
+def ptb_raw_data(data_path=None, cache_dir=None):
   """Load PTB raw data from data directory "data_path".
 
   Reads PTB text files, converts strings to integer ids,
@@ -60,30 +110,67 @@ def ptb_raw_data(data_path=None):
   Args:
     data_path: string path to the directory where simple-examples.tgz has
       been extracted.
+    cache_dir: optional directory for the token id cache. The first run
+      writes the vocabulary and int32 token ids there, keyed on the hash of
+      the text files, and later runs memory map them instead of tokenizing.
 
   Returns:
     tuple (train_data, valid_data, test_data, vocabulary)
-    where each of the data objects can be passed to PTBIterator.
+    where each of the data objects is an int32 numpy array of token ids
+    that can be passed to ptb_producer.
   """
 
   train_path = os.path.join(data_path, "ptb.train.txt")
   valid_path = os.path.join(data_path, "ptb.valid.txt")
   test_path = os.path.join(data_path, "ptb.test.txt")
 
-  word_to_id = _build_vocab(train_path)
-  train_data = _file_to_word_ids(train_path, word_to_id)
-  valid_data = _file_to_word_ids(valid_path, word_to_id)
-  test_data = _file_to_word_ids(test_path, word_to_id)
+  if cache_dir is not None:
+    cache_path = os.path.join(
+      cache_dir, "ptb_" + _files_hash([train_path, valid_path, test_path]))
+    if os.path.isdir(cache_path):
+      (train_data, valid_data, test_data), vocabulary = _load_cache(cache_path)
+      return train_data, valid_data, test_data, vocabulary
+
+  train_words = _read_words(train_path)
+  words, counts = _count_words(train_words)
+  word_to_id = dict(zip(words, range(len(words))))
+  train_data = _words_to_ids(train_words, word_to_id)
+  valid_data = _words_to_ids(_read_words(valid_path), word_to_id)
+  test_data = _words_to_ids(_read_words(test_path), word_to_id)
   vocabulary = len(word_to_id)
+
+  if cache_dir is not None:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    _write_cache(cache_path, words, counts,
+                 [train_data, valid_data, test_data])
   return train_data, valid_data, test_data, vocabulary
 
 
+# graph -> [(initializer, placeholder, value)] of the ptb_producer data
+_DATA_FEEDS = weakref.WeakKeyDictionary()
+
+
+def initialize_data(session):
+  """Load the data of every ptb_producer in the session's graph.
+
+  Must be run once after the session is created and before the producers
+  are used. The data variables are in no collection, so neither
+  tf.global_variables_initializer nor the savers touch them.
+  """
+  for initializer, placeholder, value in _DATA_FEEDS.get(session.graph, []):
+    session.run(initializer, feed_dict={placeholder: value})
+
+
 def ptb_producer(raw_data, batch_size, num_steps, name=None):
   """Iterate on the raw PTB data.
 
   This chunks up raw_data into batches of examples and returns Tensors that
   are drawn from these batches.
 
+  The data is held in a variable that initialize_data fills through a
+  placeholder, so the GraphDef does not grow with the corpus.
+
   Args:
     raw_data: one of the raw data outputs from ptb_raw_data.
     batch_size: int, the batch size.
@@ -95,22 +182,25 @@ def ptb_producer(raw_data, batch_size, num_steps, name=None):
     of the tuple is the same data time-shifted to the right by one.
 
   Raises:
-    tf.errors.InvalidArgumentError: if batch_size or num_steps are too high.
+    ValueError: if batch_size or num_steps are too high.
   """
-  with tf.name_scope(name, "PTBProducer", [raw_data, batch_size, num_steps]):
-    raw_data = tf.convert_to_tensor(raw_data, name="raw_data", dtype=tf.int32)
+  with tf.name_scope(name, "PTBProducer", [batch_size, num_steps]):
+    raw_data = np.asarray(raw_data, dtype=np.int32)
 
-    data_len = tf.size(raw_data)
+    data_len = raw_data.size
     batch_len = data_len // batch_size
-    data = tf.reshape(raw_data[0 : batch_size * batch_len],
-                      [batch_size, batch_len])
-
     epoch_size = (batch_len - 1) // num_steps
-    assertion = tf.assert_positive(
-        epoch_size,
-        message="epoch_size == 0, decrease batch_size or num_steps")
-    with tf.control_dependencies([assertion]):
-      epoch_size = tf.identity(epoch_size, name="epoch_size")
+    if epoch_size <= 0:
+      raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+    with tf.device("/cpu:0"):
+      data_feed = tf.placeholder(tf.int32, [batch_size, batch_len],
+                                 name="raw_data")
+      data = tf.Variable(data_feed, trainable=False, collections=[],
+                         name="data")
+    _DATA_FEEDS.setdefault(tf.get_default_graph(), []).append(
+      (data.initializer, data_feed,
+       raw_data[0 : batch_size * batch_len].reshape([batch_size, batch_len])))
 
     i = tf.train.range_input_producer(epoch_size, shuffle=False).dequeue()
     x = tf.strided_slice(data, [0, i * num_steps],
@@ -120,3 +210,43 @@ def ptb_producer(raw_data, batch_size, num_steps, name=None):
                          [batch_size, (i + 1) * num_steps + 1])
     y.set_shape([batch_size, num_steps])
     return x, y
+
+
+def ptb_bptt_iterator(raw_data, batch_size, num_steps, std_steps,
+                      bucket_width=5, min_steps=5, max_steps=None, rng=None):
+  """Iterate on raw_data in contiguous windows of random length.
+
+  The window lengths are drawn from N(num_steps, std_steps**2), rounded to a
+  multiple of bucket_width and clipped to [min_steps, max_steps], so a model
+  with a dynamic time dimension only ever sees a few distinct shapes. Every
+  batch row continues where it stopped in the previous window, so the final
+  state of one batch is the initial state of the next.
+
+  Args:
+    raw_data: one of the raw data outputs from ptb_raw_data.
+    batch_size: int, the batch size.
+    num_steps: int, the mean window length.
+    std_steps: float, the standard deviation of the window length.
+    bucket_width: int, window lengths are multiples of this.
+    min_steps: int, the shortest window.
+    max_steps: int, the longest window, 2 * num_steps by default.
+    rng: optional numpy RandomState.
+
+  Yields:
+    Pairs of int32 arrays (x, y) of shape [batch_size, steps], y being x
+    shifted right by one.
+  """
+  if rng is None:
+    rng = np.random
+  if max_steps is None:
+    max_steps = 2 * num_steps
+  raw_data = np.asarray(raw_data, dtype=np.int32)
+  batch_len = raw_data.size // batch_size
+  data = raw_data[0 : batch_size * batch_len].reshape([batch_size, batch_len])
+  i = 0
+  while i < batch_len - 1:
+    steps = bucket_width * int(round(
+      rng.normal(num_steps, std_steps) / float(bucket_width)))
+    steps = min(max(steps, min_steps), max_steps, batch_len - 1 - i)
+    yield data[:, i : i + steps], data[:, i + 1 : i + steps + 1]
+    i += steps
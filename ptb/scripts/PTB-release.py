@@ -7,12 +7,7 @@ import cPickle as pickle
 sys.path.append('../model')
 from ptb_word_lm import *
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import sys
-sys.path.append("../tuner_utils/")
-from debug_plot import plot_func
+from metrics_log import MetricsLog
 
 import argparse
 
@@ -23,6 +18,24 @@ parser.add_argument('--seed', type=int, default=1, help='random seed')
 parser.add_argument('--opt_method', type=str, default="YF", help='optimizer')
 parser.add_argument('--log_dir', type=str, default="results/", help="log folder")
 parser.add_argument('--h_max_log_smooth', action='store_true')
+parser.add_argument('--cache_dir', type=str, default="../../data/ptb/cache",
+                    help='token id cache for the PTB text files')
+parser.add_argument('--rnn_mode', type=str, default="basic",
+                    help='basic (unrolled), dynamic (while_loop) or block (fused LSTMBlockCell)')
+parser.add_argument('--num_sampled', type=int, default=0,
+                    help='negative classes of the sampled softmax for training, 0 for full softmax')
+parser.add_argument('--eval_streams', type=int, default=0,
+                    help='parallel zero state streams of a test evaluation at the end of training; 0 keeps the batch 1 / step 1 test model and skips it')
+parser.add_argument('--eval_steps', type=int, default=35,
+                    help='unroll length of the multi stream test evaluation')
+parser.add_argument('--sparse_embedding', action='store_true',
+                    help='deduplicated embedding lookup and sparse YF update of the touched rows')
+parser.add_argument('--tie_embeddings', action='store_true',
+                    help='share the embedding with the softmax weights')
+parser.add_argument('--softmax_rank', type=int, default=0,
+                    help='rank of the factorized softmax (or tied embedding), 0 for full rank')
+parser.add_argument('--stateful', action='store_true',
+                    help='keep the LSTM state in variables updated by the train op instead of feeding it')
 
 args = parser.parse_args()
 #print("use log smooth h_max ", args.h_max_log_smooth)
@@ -30,8 +43,12 @@ args = parser.parse_args()
 def construct_model(config, eval_config, raw_data, opt_method):
   train_data, valid_data, test_data, _ = raw_data
 
-  eval_config.batch_size = 1
-  eval_config.num_steps = 1
+  if args.eval_streams > 0:
+    eval_config.batch_size = args.eval_streams
+    eval_config.num_steps = args.eval_steps
+  else:
+    eval_config.batch_size = 1
+    eval_config.num_steps = 1
 
   initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
   with tf.name_scope("Train"):
@@ -45,32 +62,15 @@ def construct_model(config, eval_config, raw_data, opt_method):
       mvalid = PTBModel(is_training=False, config=config, input_=valid_input, opt_method=opt_method)
 
   with tf.name_scope("Test"):
-    test_input = PTBInput(config=eval_config, data=test_data, name="TestInput")
+    if args.eval_streams > 0:
+      test_input = PTBStreamInput(config=eval_config, data=test_data, name="TestInput")
+    else:
+      test_input = PTBInput(config=eval_config, data=test_data, name="TestInput")
     with tf.variable_scope("Model", reuse=True, initializer=initializer):
       mtest = PTBModel(is_training=False, config=eval_config, input_=test_input, opt_method=opt_method)
 
   return m, mvalid, mtest
 
-loss_list_visual = []
-local_curv_list = [] 
-max_curv_list = []
-min_curv_list = []
-lr_g_norm_list = [] 
-lr_g_norm_squared_list = [] 
-lr_list = [] 
-lr_t_list = []
-dr_list = [] 
-mu_list = [] 
-mu_t_list = [] 
-grad_avg_norm_list = []
-dist_list = []
-grad_var_list = []
-move_lr_g_norm_list = [] 
-move_lr_g_norm_squared_list = [] 
-fast_view_act_list = [] 
-lr_grad_norm_clamp_act_list = []
-
-
 def train_single_step(sess, model, model_eval, model_test, eval_op, iter_id, test_int=1000):
   global state
   global iters
@@ -79,11 +79,13 @@ def train_single_step(sess, model, model_eval, model_test, eval_op, iter_id, tes
   if iter_id % model.input.epoch_size == 0:
     iters = 0
     costs = 0
-    state = sess.run(m.initial_state)
+    if model.stateful:
+      sess.run(model.reset_state_op)
+    else:
+      state = sess.run(m.initial_state)
 
   fetches = {
     "cost": model.cost,
-    "final_state": model.final_state,
     "grads": model.grads,
     "grad_norm": model.grad_norm,
     "model": model.tvars,
@@ -99,36 +101,24 @@ def train_single_step(sess, model, model_eval, model_test, eval_op, iter_id, tes
     fetches["eval_op"] = eval_op
 
   feed_dict = {}
-  for i, (c, h) in enumerate(model.initial_state):
-    feed_dict[c] = state[i].c
-    feed_dict[h] = state[i].h
+  if not model.stateful:
+    # the stateful train op carries the state over in variables
+    fetches["final_state"] = model.final_state
+    for i, (c, h) in enumerate(model.initial_state):
+      feed_dict[c] = state[i].c
+      feed_dict[h] = state[i].h
   vals = sess.run(fetches, feed_dict)
   cost = vals["cost"]
-  state = vals["final_state"]
+  if not model.stateful:
+    state = vals["final_state"]
   grads = vals["grads"]
   grad_norm = vals["grad_norm"]
   w = vals["model"]
 
 
-  # for printing issue
-  loss_list_visual.append(cost)
-  local_curv_list.append(vals["grad_norm"]**2)
-  max_curv_list.append(vals["h_max"])
-  min_curv_list.append(vals["h_min"])
-  lr_g_norm_list.append(vals["lr"] * vals["grad_norm"]) 
-  lr_g_norm_squared_list.append(vals["lr"] * vals["grad_norm"]**2) 
-  lr_list.append(vals["lr"])
-  lr_t_list.append(vals["lr"])
-  dr_list.append((vals["h_max"] + 1e-6) / (vals["h_min"] + 1e-6)) 
-  mu_list.append(vals["mu"]) 
-  mu_t_list.append(vals["mu"]) 
-  # grad_avg_norm_list = []
-  dist_list.append(vals["dist_to_opt"])
-  grad_var_list.append(vals["grad_var"])
-  # move_lr_g_norm_list = [] 
-  # move_lr_g_norm_squared_list = [] 
-  # fast_view_act_list = [] 
-  # lr_grad_norm_clamp_act_list = []
+  metrics.log(iter=iter_id, cost=cost, grad_norm=grad_norm, h_max=vals["h_max"],
+              h_min=vals["h_min"], lr=vals["lr"], mu=vals["mu"],
+              dist_to_opt=vals["dist_to_opt"], grad_var=vals["grad_var"])
 
   costs += cost
   iters += model.input.num_steps
@@ -137,23 +127,16 @@ def train_single_step(sess, model, model_eval, model_test, eval_op, iter_id, tes
   val_perp = None
   test_perp = None
 
-  if iter_id == 10 or iter_id == 30 or iter_id == 100 or iter_id %1000 == 0:
-    plot_func(args.log_dir, iter_id, loss_list_visual, local_curv_list, max_curv_list, min_curv_list,
-             lr_g_norm_list, lr_g_norm_squared_list, lr_list, lr_t_list, dr_list, 
-             mu_list, mu_t_list, grad_avg_norm_list,
-             dist_list, grad_var_list, move_lr_g_norm_list, move_lr_g_norm_squared_list, 
-             fast_view_act_list, lr_grad_norm_clamp_act_list)
-    print("figure plotted")
-
-
   if iter_id % (model.input.epoch_size // 10) == 10:
     print("%.3f perplexity: %.3f speed: %.0f wps" %
     (iter_id * 1.0 / model.input.epoch_size, np.exp(costs * model.input.num_steps / iters), 0))
 
   if iter_id % test_int == 0 and iter_id != 0:
       print("test interval ", test_int)
+      sess.run(model.sparse_flush_op)
       val_perp = run_epoch(sess, model_eval)
       print("Valid Perplexity: %.3f" % val_perp)
+      valid_metrics.log(iter=iter_id, val_perp=val_perp)
   #     test_perp = run_epoch(sess, model_test)
   #     print("Test Perplexity: %.3f" % test_perp)
 
@@ -164,12 +147,21 @@ def train_single_step(sess, model, model_eval, model_test, eval_op, iter_id, tes
 data_path = "../../data/ptb/data"
 train_config = SmallConfig()
 eval_config = SmallConfig()
-raw_data = reader.ptb_raw_data(data_path)
+raw_data = reader.ptb_raw_data(data_path, cache_dir=args.cache_dir)
 
 # construct models
 tf.reset_default_graph()
 opt_method = 'YF'
 train_config.h_max_log_smooth = args.h_max_log_smooth
+train_config.rnn_mode = eval_config.rnn_mode = args.rnn_mode
+train_config.stateful = eval_config.stateful = args.stateful
+train_config.sparse_embedding = eval_config.sparse_embedding = args.sparse_embedding
+train_config.tie_embeddings = eval_config.tie_embeddings = args.tie_embeddings
+train_config.softmax_rank = eval_config.softmax_rank = args.softmax_rank
+if args.num_sampled > 0:
+  train_config.num_sampled = args.num_sampled
+  train_config.unigram_counts = np.bincount(raw_data[0],
+                                            minlength=train_config.vocab_size)
 m, m_val, m_test = construct_model(train_config, eval_config, raw_data, args.opt_method)
 
 lr_as = tf.assign(m._lr, args.lr)
@@ -185,7 +177,6 @@ sv = tf.train.Supervisor(logdir='./tmp')
 # set trainining parameters
 num_step = 2323 * 13
 train_batch_size = 64
-display_interval=1000
 test_int = 1000
 n_core=20
 #general_log_dir = "../results"
@@ -200,14 +191,16 @@ np.random.seed(args.seed)
 tf.set_random_seed(args.seed)
 print("using random seed", args.seed)
 
-loss_list = []
-train_perp_list = []
-val_perp_list = []
-test_perp_list = []
+# per step metrics go to binary logs, plot them with plot_metrics.py
+metrics = MetricsLog(log_dir + "/train_metrics.bin",
+                     ["iter", "cost", "grad_norm", "h_max", "h_min", "lr", "mu",
+                      "dist_to_opt", "grad_var"])
+valid_metrics = MetricsLog(log_dir + "/valid_metrics.bin", ["iter", "val_perp"])
 with sv.managed_session(config=tf.ConfigProto(inter_op_parallelism_threads=n_core,
           intra_op_parallelism_threads=n_core,
           gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.45))) as sess:
   sess.run(init_op)
+  reader.initialize_data(sess)
   state = sess.run(m.initial_state)
   # costs and iters are for calculating perplexity
   costs = 0
@@ -220,32 +213,13 @@ with sv.managed_session(config=tf.ConfigProto(inter_op_parallelism_threads=n_cor
     loss, train_perp, val_perp, test_perp = \
       train_single_step(sess, m, m_val, m_test, m.train_op, iter_id)
 
-    loss_list.append(loss)
-    if train_perp is not None:
-      train_perp_list.append(train_perp)
-    if val_perp is not None:
-      val_perp_list.append(val_perp)
-    if test_perp is not None:
-      test_perp_list.append(test_perp)
-
-    if iter_id % display_interval == 0 and iter_id != 0:
-      def running_mean(x, N):
-        cumsum = np.cumsum(np.insert(x, 0, 0))
-        return (cumsum[N:] - cumsum[:-N]) / N
-      plt.figure()
-      plt.semilogy(loss_list, '.', alpha=0.2, label="Loss")
-      plt.semilogy(running_mean(loss_list,100), label="Average Loss")
-      plt.xlabel('Iterations')
-      plt.ylabel('Loss')
-      plt.legend()
-      plt.grid()
-      ax = plt.subplot(111)
-      ax.legend(loc='upper center', bbox_to_anchor=(0.5, 1.05),
-         ncol=3, fancybox=True, shadow=True)
-      with open(log_dir + "/loss.txt", "w") as f:
-	np.savetxt(f, np.array(loss_list) )
-      with open(log_dir + "/val_perp.txt", "w") as f:
-        np.savetxt(f, np.array(val_perp_list) )
-
-      plt.savefig(log_dir + "/fig_loss_iter_" + str(iter_id) + ".jpg")
-      plt.close()
+  sess.run(m.sparse_flush_op)
+  if args.eval_streams > 0:
+    # not the sequential batch 1 perplexity, each stream starts from the
+    # zero state
+    test_perp = run_stream_eval(sess, m_test)
+    print("Multi stream Test Perplexity: %.3f" % test_perp)
+    with open(log_dir + "/test_perp.txt", "w") as f:
+      np.savetxt(f, np.array([test_perp]) )
+  metrics.close()
+  valid_metrics.close()
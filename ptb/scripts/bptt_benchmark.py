@@ -0,0 +1,88 @@
+from __future__ import print_function
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('../model')
+from ptb_word_lm import *
+
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--data_path', type=str, default="../../data/ptb/data")
+parser.add_argument('--cache_dir', type=str, default="../../data/ptb/cache",
+                    help='token id cache for the PTB text files')
+parser.add_argument('--opt_method', type=str, default="sgd", help='optimizer')
+parser.add_argument('--n_epoch', type=int, default=4, help='training epochs')
+parser.add_argument('--bptt_std', type=float, default=5.0,
+                    help='std of the variable window length')
+parser.add_argument('--rnn_mode', type=str, default="dynamic",
+                    help='dynamic or block')
+parser.add_argument('--n_core', type=int, default=16, help='cpu threads')
+
+
+def train_and_eval(args, raw_data, bptt_std):
+  """Train words/sec and validation perplexity after each epoch of the
+  small config, with fixed (bptt_std 0) or random length windows."""
+  train_data, valid_data, _, _ = raw_data
+  config = SmallConfig()
+  config.rnn_mode = args.rnn_mode
+  config.bptt_std = bptt_std
+
+  tf.reset_default_graph()
+  tf.set_random_seed(1)
+  initializer = tf.random_uniform_initializer(-config.init_scale,
+                                              config.init_scale)
+  with tf.name_scope("Train"):
+    if bptt_std > 0:
+      train_input = PTBFeedInput(config=config, data=train_data,
+                                 name="TrainInput")
+    else:
+      train_input = PTBInput(config=config, data=train_data, name="TrainInput")
+    with tf.variable_scope("Model", reuse=None, initializer=initializer):
+      m = PTBModel(is_training=True, config=config, input_=train_input,
+                   opt_method=args.opt_method)
+  with tf.name_scope("Valid"):
+    valid_input = PTBInput(config=config, data=valid_data, name="ValidInput")
+    with tf.variable_scope("Model", reuse=True, initializer=initializer):
+      mvalid = PTBModel(is_training=False, config=config, input_=valid_input)
+
+  results = []
+  config_proto = tf.ConfigProto(intra_op_parallelism_threads=args.n_core,
+                                inter_op_parallelism_threads=args.n_core)
+  with tf.Session(config=config_proto) as sess:
+    sess.run(tf.global_variables_initializer())
+    reader.initialize_data(sess)
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+    rng = np.random.RandomState(1)
+    for i in range(args.n_epoch):
+      lr_decay = config.lr_decay ** max(i + 1 - config.max_epoch, 0.0)
+      m.assign_lr(sess, config.learning_rate * lr_decay)
+      start = time.time()
+      if bptt_std > 0:
+        run_bptt_epoch(sess, m, eval_op=m.train_op, rng=rng)
+      else:
+        run_epoch(sess, m, eval_op=m.train_op)
+      wps = len(train_data) / (time.time() - start)
+      results.append((wps, run_epoch(sess, mvalid)))
+    coord.request_stop()
+    coord.join(threads)
+  return results
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  # ptb_word_lm's tf.flags parse sys.argv on first use and reject the
+  # flags of this script
+  sys.argv = sys.argv[:1]
+  raw_data = reader.ptb_raw_data(args.data_path, cache_dir=args.cache_dir)
+  for name, bptt_std in [("fixed num_steps", 0.0),
+                         ("random length, std %.1f" % args.bptt_std,
+                          args.bptt_std)]:
+    for i, (wps, valid_perp) in enumerate(
+        train_and_eval(args, raw_data, bptt_std)):
+      print("%s epoch %d: %.0f wps, valid perplexity %.3f"
+            % (name, i + 1, wps, valid_perp))
@@ -0,0 +1,47 @@
+from __future__ import print_function
+import sys
+import numpy as np
+
+sys.path.append('../../tuner_utils')
+from debug_plot import plot_func
+from metrics_log import read_metrics_log
+
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--log_dir', type=str, default="results/", help="log folder of PTB-release.py")
+parser.add_argument('--iters', type=str, default="",
+                    help='comma separated iterations to plot up to, default the last one')
+
+
+def plot_metrics(log_dir, train, iter_id):
+  """The debug_plot figures of the PTB-release.py train metrics up to
+  iter_id."""
+  keep = train["iter"] <= iter_id
+  m = dict((name, values[keep]) for name, values in train.items())
+  lr_g_norm = m["lr"] * m["grad_norm"]
+  plot_func(log_dir, iter_id, m["cost"], m["grad_norm"]**2, m["h_max"], m["h_min"],
+            lr_g_norm, lr_g_norm * m["grad_norm"], m["lr"], m["lr"],
+            (m["h_max"] + 1e-6) / (m["h_min"] + 1e-6),
+            m["mu"], m["mu"], [],
+            m["dist_to_opt"], m["grad_var"], [], [],
+            [], [])
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  train = read_metrics_log(args.log_dir + "/train_metrics.bin")
+  if args.iters:
+    iters = [int(i) for i in args.iters.split(",")]
+  else:
+    iters = [int(train["iter"][-1])]
+  for iter_id in iters:
+    plot_metrics(args.log_dir, train, iter_id)
+    print("figure plotted", iter_id)
+
+  # plain text copies of the loss and validation perplexity
+  valid = read_metrics_log(args.log_dir + "/valid_metrics.bin")
+  with open(args.log_dir + "/loss.txt", "w") as f:
+    np.savetxt(f, train["cost"])
+  with open(args.log_dir + "/val_perp.txt", "w") as f:
+    np.savetxt(f, valid["val_perp"])
@@ -0,0 +1,84 @@
+from __future__ import print_function
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('../model')
+from ptb_word_lm import *
+
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--config', type=str, default="small",
+                    help='small, medium or large')
+parser.add_argument('--opt_method', type=str, default="YF", help='optimizer')
+parser.add_argument('--n_warmup', type=int, default=5, help='untimed steps')
+parser.add_argument('--n_step', type=int, default=50, help='timed steps')
+parser.add_argument('--n_core', type=int, default=16, help='cpu threads')
+
+
+def time_rnn_mode(args, rnn_mode):
+  """Graph build seconds, train words/sec and (name, shape) of the variables
+  of a PTBModel in the given rnn mode, on random token ids."""
+  config = {"small": SmallConfig, "medium": MediumConfig,
+            "large": LargeConfig}[args.config]()
+  config.rnn_mode = rnn_mode
+  data = np.random.randint(0, config.vocab_size, size=[
+    config.batch_size * (config.num_steps * (args.n_warmup + args.n_step) + 1)],
+    dtype=np.int32)
+
+  tf.reset_default_graph()
+  tf.set_random_seed(1)
+  start = time.time()
+  initializer = tf.random_uniform_initializer(-config.init_scale,
+                                              config.init_scale)
+  train_input = PTBInput(config=config, data=data, name="TrainInput")
+  with tf.variable_scope("Model", reuse=None, initializer=initializer):
+    m = PTBModel(is_training=True, config=config, input_=train_input,
+                 opt_method=args.opt_method)
+  build_time = time.time() - start
+  variables = sorted((v.op.name, tuple(v.get_shape().as_list()))
+                     for v in tf.global_variables()
+                     if v.op.name.startswith("Model/RNN/"))
+
+  config_proto = tf.ConfigProto(intra_op_parallelism_threads=args.n_core,
+                                inter_op_parallelism_threads=args.n_core)
+  with tf.Session(config=config_proto) as sess:
+    sess.run(tf.global_variables_initializer())
+    reader.initialize_data(sess)
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+    m.assign_lr(sess, config.learning_rate)
+    state = sess.run(m.initial_state)
+    fetches = {"cost": m.cost, "final_state": m.final_state,
+               "train_op": m.train_op}
+    for step in range(args.n_warmup + args.n_step):
+      if step == args.n_warmup:
+        start = time.time()
+      feed_dict = {}
+      for i, (c, h) in enumerate(m.initial_state):
+        feed_dict[c] = state[i].c
+        feed_dict[h] = state[i].h
+      state = sess.run(fetches, feed_dict)["final_state"]
+    wps = args.n_step * config.batch_size * config.num_steps \
+      / (time.time() - start)
+    coord.request_stop()
+    coord.join(threads)
+  return build_time, wps, variables
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  np.random.seed(1)
+  results = {}
+  for rnn_mode in ["basic", "dynamic", "block"]:
+    build_time, wps, variables = time_rnn_mode(args, rnn_mode)
+    results[rnn_mode] = variables
+    print("%s: graph build %.2f s, %.0f wps" % (rnn_mode, build_time, wps))
+  # all modes have to restore each other's checkpoints
+  for rnn_mode in ["dynamic", "block"]:
+    if results[rnn_mode] != results["basic"]:
+      print("%s rnn variables differ from basic:" % rnn_mode,
+            results[rnn_mode], results["basic"])
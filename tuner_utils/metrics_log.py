@@ -0,0 +1,91 @@
+from __future__ import print_function
+import os
+import threading
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+import numpy as np
+
+
+# records are float64 rows; row 0 is a header holding the record count
+_DTYPE = np.float64
+
+
+def _fields_path(path):
+  return path + ".fields"
+
+
+class MetricsLog(object):
+  """Append only log of fixed size float records in a memory mapped file.
+
+  log() only puts a tuple on a queue; a background thread copies the
+  records into the mapped file, doubling it when full, and publishes the
+  record count in the header row every flush_every records. Fields missing
+  from a log() call are stored as nan. Read it back with read_metrics_log.
+  """
+  def __init__(self, path, fields, capacity=4096, flush_every=100):
+    self._path = path
+    self._fields = list(fields)
+    self._capacity = capacity
+    self._flush_every = flush_every
+    self._count = 0
+    with open(_fields_path(path), "w") as f:
+      f.write("\n".join(self._fields) + "\n")
+    self._data = np.memmap(path, dtype=_DTYPE, mode="w+",
+                           shape=(capacity + 1, len(self._fields)))
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._write_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  @property
+  def fields(self):
+    return self._fields
+
+  def log(self, **values):
+    self._queue.put(tuple(values.get(name, np.nan) for name in self._fields))
+
+  def _grow(self):
+    self._data.flush()
+    del self._data
+    self._capacity *= 2
+    with open(self._path, "r+b") as f:
+      f.truncate((self._capacity + 1) * len(self._fields)
+                 * np.dtype(_DTYPE).itemsize)
+    self._data = np.memmap(self._path, dtype=_DTYPE, mode="r+",
+                           shape=(self._capacity + 1, len(self._fields)))
+
+  def _flush(self):
+    self._data[0, 0] = self._count
+    self._data.flush()
+
+  def _write_loop(self):
+    while True:
+      record = self._queue.get()
+      if record is None:
+        break
+      if self._count == self._capacity:
+        self._grow()
+      self._count += 1
+      self._data[self._count] = record
+      if self._count % self._flush_every == 0:
+        self._flush()
+    self._flush()
+
+  def close(self):
+    """Write the queued records and the final count."""
+    self._queue.put(None)
+    self._thread.join()
+    del self._data
+
+
+def read_metrics_log(path):
+  """Dict of field name -> array of the records written so far."""
+  with open(_fields_path(path)) as f:
+    fields = f.read().split()
+  data = np.memmap(path, dtype=_DTYPE, mode="r").reshape(-1, len(fields))
+  count = int(data[0, 0])
+  return dict((name, np.array(data[1:count + 1, i]))
+              for i, name in enumerate(fields))
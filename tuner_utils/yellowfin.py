@@ -17,6 +17,133 @@ from tensorflow.python.framework import ops
 EPS = 1e-6
 LARGE_FLOAT_VAL = 1e15
 
+
+def _dedupe_indexed_slices(grad):
+  """Sum the values of repeated indices, so each row appears once."""
+  unique_indices, new_index = tf.unique(grad.indices)
+  values = tf.unsorted_segment_sum(
+    grad.values, new_index, tf.shape(unique_indices)[0])
+  return ops.IndexedSlices(values, unique_indices, grad.dense_shape)
+
+
+def _row_shape(values):
+  # broadcast a per row scalar against the rows of values
+  return [-1] + [1] * (values.get_shape().ndims - 1)
+
+
+class LazyMomentum(object):
+  """
+  Momentum update of the rows in IndexedSlices gradients only.
+
+  A row that was not in the gradient for some steps keeps moving with its
+  decaying momentum in the dense algorithm. Here it catches up on those
+  steps, with the lr and mu of each of them, the next time it is touched,
+  so the result matches the dense momentum update. The lr and mu of the
+  last `window` steps are kept for this, and every `window` steps all rows
+  are brought up to date and the window restarts.
+  """
+
+  def __init__(self, learning_rate, momentum, window=100,
+               name="LazyMomentum"):
+    self._lr = learning_rate
+    self._mu = momentum
+    self._window = window
+    self._name = name
+    with tf.variable_scope(name):
+      # steps taken in the current window
+      self._step = tf.Variable(0, trainable=False, name="step")
+      self._lr_hist = tf.Variable(
+        np.zeros([window, ]), dtype=tf.float32, name="lr_hist",
+        trainable=False)
+      self._mu_hist = tf.Variable(
+        np.zeros([window, ]), dtype=tf.float32, name="mu_hist",
+        trainable=False)
+    # var -> (momentum accumulator, last step of each row in the window)
+    self._slots = {}
+
+  def _get_slots(self, var):
+    if var not in self._slots:
+      with tf.control_dependencies(None), ops.colocate_with(var):
+        accum = tf.Variable(
+          tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+          trainable=False, name=var.op.name + "/" + self._name)
+        last = tf.Variable(
+          tf.zeros([var.get_shape()[0]], dtype=tf.int32), trainable=False,
+          name=var.op.name + "/" + self._name + "_step")
+      self._slots[var] = (accum, last)
+    return self._slots[var]
+
+  def _catch_up(self, last, end):
+    """
+    For rows last updated at window step `last`, the momentum decay and the
+    distance moved per unit of momentum over the steps last < q <= end:
+    prod_q mu_q and sum_q lr_q * prod_{last < j <= q} mu_j.
+    """
+    q = tf.range(1, self._window + 1)
+    skipped = tf.to_float(tf.logical_and(
+      tf.greater(tf.expand_dims(q, 0), tf.expand_dims(last, 1)),
+      tf.less_equal(tf.expand_dims(q, 0), end)))
+    decay = tf.cumprod(
+      skipped * tf.expand_dims(self._mu_hist, 0) + (1.0 - skipped), axis=1)
+    moved = tf.reduce_sum(
+      skipped * decay * tf.expand_dims(self._lr_hist, 0), axis=1)
+    return decay[:, -1], moved
+
+  def _sparse_update(self, grad, var, step):
+    accum, last = self._get_slots(var)
+    with ops.colocate_with(var):
+      decay, moved = self._catch_up(tf.gather(last, grad.indices), step - 1)
+      row_accum = tf.gather(accum, grad.indices)
+      row_var = tf.gather(var, grad.indices) \
+        - tf.reshape(moved, _row_shape(row_accum)) * row_accum
+      row_accum = tf.reshape(decay, _row_shape(row_accum)) * row_accum \
+        * self._mu + grad.values
+      row_var -= self._lr * row_accum
+      with tf.control_dependencies([row_var, row_accum]):
+        return tf.group(
+          tf.scatter_update(var, grad.indices, row_var),
+          tf.scatter_update(accum, grad.indices, row_accum),
+          tf.scatter_update(
+            last, grad.indices, tf.fill(tf.shape(grad.indices), step)))
+
+  def _flush(self, var, step):
+    accum, last = self._slots[var]
+    with ops.colocate_with(var):
+      decay, moved = self._catch_up(last.value(), step)
+      new_var = var - tf.reshape(moved, _row_shape(accum)) * accum
+      new_accum = tf.reshape(decay, _row_shape(accum)) * accum
+      with tf.control_dependencies([new_var, new_accum]):
+        return tf.group(tf.assign(var, new_var), tf.assign(accum, new_accum),
+                        tf.assign(last, tf.fill(tf.shape(last), step)))
+
+  def flush_op(self):
+    """Op bringing every row up to date, e.g. before evaluation."""
+    step = self._step.value()
+    return tf.group(*[self._flush(var, step) for var in self._slots])
+
+  def apply_gradients(self, grads_vars):
+    """Apply a step of IndexedSlices gradients with unique indices."""
+    step = self._step + 1
+    hist_ops = [
+      tf.scatter_update(self._lr_hist, step - 1, self._lr),
+      tf.scatter_update(self._mu_hist, step - 1, self._mu)]
+    with tf.control_dependencies(hist_ops):
+      update_op = tf.group(
+        *[self._sparse_update(g, v, step) for g, v in grads_vars])
+
+    def restart_window():
+      flush_ops = [self._flush(v, step) for _, v in grads_vars]
+      with tf.control_dependencies(flush_ops):
+        reset_ops = [tf.assign(last, tf.zeros_like(last))
+                     for _, last in self._slots.values()]
+        reset_ops.append(tf.assign(self._step, 0))
+      return tf.group(*reset_ops)
+
+    with tf.control_dependencies([update_op]):
+      window_op = tf.cond(tf.equal(step, self._window), restart_window,
+                          lambda: tf.group(tf.assign(self._step, step)))
+    return tf.group(update_op, window_op)
+
 class YFOptimizer(object):
   """
   Optimizer that implements the YellowFin algorithm.
@@ -33,7 +160,8 @@ class YFOptimizer(object):
                sparsity_debias=False, use_locking=False, name="YellowFin",
                use_nesterov=False, use_unsmoothed_lr_mu=True,
                h_max_log_smooth=True, h_min_log_smooth=True,
-               use_adapt_grad_clip=True, stat_protect_fac=100.0):
+               use_adapt_grad_clip=True, stat_protect_fac=100.0,
+               weight_decay=0.0, sparse_update=False, sparse_window=100):
     """
     Construct a new YellowFin optimizer.
 
@@ -58,6 +186,16 @@ class YFOptimizer(object):
         applying gradients. Defaults to "YellowFin".
       use_nesterov: If True, the underlying MomentumOptimizer uses Nesterov
         Momentum. Set to False in the default YellowFin algorithm.
+      weight_decay: Python scalar. Rate of the decoupled weight decay
+        `var -= lr * weight_decay * var` applied together with the momentum
+        update. The decay is not part of the gradient, so it does not enter
+        the curvature and variance measurements. 0.0 turns it off.
+      sparse_update: If True, IndexedSlices gradients (e.g. of embeddings)
+        are deduplicated and never densified: the statistics only read the
+        touched rows and the variables get a LazyMomentum update, which
+        matches the dense update. Run `sparse_flush_op()` before reading
+        all rows, e.g. for evaluation or checkpoints.
+      sparse_window: Steps of lr and mu history kept by LazyMomentum.
 
     Notes:
       `clip_thresh` is the threshold value on ||lr * gradient||
@@ -96,6 +234,15 @@ class YFOptimizer(object):
       self._lr_var * self.lr_factor, self._mu_var + delta_mu,
       use_locking, name, use_nesterov)
 
+    # row wise momentum for sparse gradients
+    self._sparse_update = sparse_update
+    if sparse_update:
+      if use_nesterov:
+        raise ValueError("sparse_update does not support use_nesterov")
+      self._lazy_optimizer = LazyMomentum(
+        self._lr_var * self.lr_factor, self._mu_var + delta_mu,
+        sparse_window, name + "_lazy")
+
     # moving average for statistics
     self._beta = beta
     self._moving_averager = None
@@ -131,6 +278,9 @@ class YFOptimizer(object):
     # prevent exploding gradient from ruining the statistics
     self._stat_protect_fac = stat_protect_fac
 
+    # decoupled weight decay
+    self._weight_decay = weight_decay
+
   def curvature_range(self):
     # set up the curvature window
     self._curv_win = tf.Variable(
@@ -181,11 +331,50 @@ class YFOptimizer(object):
     curv_range_ops.append(avg_op)
     return curv_range_ops
 
+  def sparse_grad_avg(self, t, g):
+    """
+    Squared norm of the moving average of the IndexedSlices gradient g of
+    t, and the op updating it, reading and writing only the rows in g.
+    The average of a row is stored as of the step it was last touched and
+    decayed by beta per skipped step when it is read again, and the squared
+    norm over all rows is kept up to date incrementally.
+    """
+    with tf.control_dependencies(None), ops.colocate_with(t):
+      avg = tf.Variable(tf.zeros(t.get_shape(), dtype=g.values.dtype),
+                        trainable=False, name="sparse_grad_avg")
+      last = tf.Variable(tf.zeros([t.get_shape()[0]], dtype=tf.int32),
+                         trainable=False, name="sparse_grad_avg_step")
+      norm_squared = tf.Variable(0.0, dtype=g.values.dtype,
+                                 trainable=False,
+                                 name="sparse_grad_avg_norm_squared")
+    step = self._global_step + 1
+    decay = tf.pow(self._beta, tf.to_float(
+      step - 1 - tf.gather(last, g.indices)))
+    old = tf.gather(avg, g.indices) * tf.reshape(decay, _row_shape(g.values))
+    new = self._beta * old + (1.0 - self._beta) * g.values
+    new_norm_squared = tf.maximum(
+      0.0, self._beta**2 * (norm_squared - tf.reduce_sum(tf.square(old)))
+      + tf.reduce_sum(tf.square(new)))
+    with tf.control_dependencies([new, new_norm_squared]):
+      update_op = tf.group(
+        tf.scatter_update(avg, g.indices, new),
+        tf.scatter_update(last, g.indices,
+                          tf.fill(tf.shape(g.indices), step)),
+        tf.assign(norm_squared, new_norm_squared))
+    if self._zero_debias:
+      new_norm_squared /= (1.0 - tf.pow(self._beta, tf.to_float(step)))**2
+    return new_norm_squared, update_op
+
   def grad_variance(self):
     grad_var_ops = []
     tensor_to_avg = []
+    sparse_avg_norm_squared = []
     for t, g in zip(self._tvars, self._grads):
-      if isinstance(g, ops.IndexedSlices):
+      if self._sparse_update and isinstance(g, ops.IndexedSlices):
+        norm_squared, update_op = self.sparse_grad_avg(t, g)
+        sparse_avg_norm_squared.append(norm_squared)
+        grad_var_ops.append(update_op)
+      elif isinstance(g, ops.IndexedSlices):
         tensor_to_avg.append(
           tf.reshape(tf.unsorted_segment_sum(
             g.values, g.indices, g.dense_shape[0]),
@@ -201,7 +390,8 @@ class YFOptimizer(object):
     self._grad_var = tf.maximum(
       tf.constant(EPS, dtype=self._grad_norm_squared_avg.dtype),
       self._grad_norm_squared_avg
-      - tf.add_n([tf.reduce_sum(val) for val in self._grad_avg_squared] ) )
+      - tf.add_n([tf.reduce_sum(val) for val in self._grad_avg_squared]
+                 + sparse_avg_norm_squared) )
     if self._sparsity_debias:
       self._grad_var *= self._sparsity_avg
     return grad_var_ops
@@ -236,8 +426,18 @@ class YFOptimizer(object):
     # are roughly estimated norm of minibatch
     # sparse gradient norm * sqrt(sparsity)
     # An extension maybe only correct the sparse blob.
-    non_zero_cnt = tf.add_n([tf.count_nonzero(g) for g in self._grads])
-    all_entry_cnt = tf.add_n([tf.size(g) for g in self._grads])
+    non_zero_cnt = []
+    all_entry_cnt = []
+    for g in self._grads:
+      if self._sparse_update and isinstance(g, ops.IndexedSlices):
+        non_zero_cnt.append(tf.count_nonzero(g.values))
+        all_entry_cnt.append(
+          tf.cast(tf.reduce_prod(g.dense_shape), tf.int32))
+      else:
+        non_zero_cnt.append(tf.count_nonzero(g))
+        all_entry_cnt.append(tf.size(g))
+    non_zero_cnt = tf.add_n(non_zero_cnt)
+    all_entry_cnt = tf.add_n(all_entry_cnt)
     self._sparsity = tf.cast(non_zero_cnt, self._grads[0].dtype) \
       / tf.cast(all_entry_cnt, self._grads[0].dtype)
     avg_op = self._moving_averager.apply([self._sparsity, ])
@@ -258,7 +458,11 @@ class YFOptimizer(object):
       if g is None:
         continue
       with ops.colocate_with(v):
-        self._grad_squared.append(tf.square(g))
+        if self._sparse_update and isinstance(g, ops.IndexedSlices):
+          # unique indices, so this is the squared dense gradient
+          self._grad_squared.append(tf.square(g.values))
+        else:
+          self._grad_squared.append(tf.square(g))
     self._grad_norm_squared = [
       tf.reduce_sum(grad_squared) for grad_squared in self._grad_squared]
 
@@ -345,12 +549,51 @@ class YFOptimizer(object):
     assign_hyper_op = tf.group(*assign_hyper_ops)
     return assign_hyper_op
 
+  def decoupled_weight_decay(self, decay_var_list):
+    decay_ops = []
+    if not self._weight_decay:
+      return decay_ops
+    lr = self._lr_var * self.lr_factor
+    for v in decay_var_list:
+      with ops.colocate_with(v):
+        decay_ops.append(tf.assign_sub(v, lr * self._weight_decay * v))
+    return decay_ops
+
+  def sparse_flush_op(self):
+    """
+    Op applying the pending momentum of the rows the sparse update skipped,
+    so every row is up to date. Only needed with `sparse_update`.
+    """
+    if not self._sparse_update:
+      return tf.no_op()
+    return self._lazy_optimizer.flush_op()
+
   def get_name(self):
       return self._optimizer.get_name()
 
-  def apply_gradients(self, grads_tvars, global_step=None, name=None):
+  def apply_gradients(self, grads_tvars, global_step=None, name=None,
+                      decay_var_list=None):
+    """
+    Apply gradients to variables.
+
+    Args:
+      grads_tvars: List of (gradient, variable) pairs.
+      global_step: Optional `Variable` to increment by one after the
+        variables have been updated.
+      name: Optional name for the returned operation.
+      decay_var_list: Optional list of variables for the decoupled weight
+        decay. Defaults to all the variables in `grads_tvars`. Only used
+        if `weight_decay` is set.
+
+    Returns:
+      An `Operation` that applies the gradients.
+    """
     self._grads, self._tvars = zip(
       *[(g, t) for g, t in grads_tvars if g is not None])
+    if self._sparse_update:
+      self._grads = [
+        _dedupe_indexed_slices(g) if isinstance(g, ops.IndexedSlices) else g
+        for g in self._grads]
 
     # for manual gradient clipping
     if self._clip_thresh_var is not None:
@@ -383,8 +626,29 @@ class YFOptimizer(object):
           self._grads, self._grads_norm = tf.clip_by_global_norm(
             self._grads, thresh)
 
-        apply_grad_op = self._optimizer.apply_gradients(
-          zip(self._grads, self._tvars), global_step, name)
+        # decay the weights before the momentum update, using the lr
+        # tuned for this step
+        if decay_var_list is None:
+          decay_var_list = self._tvars
+        decay_ops = self.decoupled_weight_decay(decay_var_list)
+        with tf.control_dependencies(decay_ops):
+          if self._sparse_update:
+            sparse = [(g, t) for g, t in zip(self._grads, self._tvars)
+                      if isinstance(g, ops.IndexedSlices)]
+            dense = [(g, t) for g, t in zip(self._grads, self._tvars)
+                     if not isinstance(g, ops.IndexedSlices)]
+            apply_ops = []
+            if dense:
+              apply_ops.append(
+                self._optimizer.apply_gradients(dense, global_step, name))
+            elif global_step is not None:
+              apply_ops.append(tf.assign_add(global_step, 1))
+            if sparse:
+              apply_ops.append(self._lazy_optimizer.apply_gradients(sparse))
+            apply_grad_op = tf.group(*apply_ops)
+          else:
+            apply_grad_op = self._optimizer.apply_gradients(
+              zip(self._grads, self._tvars), global_step, name)
 
     with tf.control_dependencies([apply_grad_op]):
       self._increment_global_step_op = tf.assign(
@@ -419,7 +683,8 @@ class YFOptimizer(object):
                aggregation_method=None,
                colocate_gradients_with_ops=False,
                name=None,
-               grad_loss=None):
+               grad_loss=None,
+               decay_var_list=None):
     """Add operations to minimize `loss` by updating `var_list`.
 
     This method simply combines calls `compute_gradients()` and
@@ -444,7 +709,8 @@ class YFOptimizer(object):
         "%s and loss %s." %
         ([str(v) for _, v in grads_and_vars], loss))
 
-    return self.apply_gradients(grads_and_vars, global_step, name)
+    return self.apply_gradients(grads_and_vars, global_step, name,
+                                decay_var_list)
 
   def get_slot(self, var, name):
     """
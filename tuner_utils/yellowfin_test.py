@@ -5,6 +5,7 @@ import tensorflow as tf
 import numpy as np
 from yellowfin import YFOptimizer
 from tensorflow.python.ops import variables
+from tensorflow.python.framework import ops
 import time
 
 
@@ -155,6 +156,92 @@ def test_lr_mu():
   print("lr and mu computing test passed!")
 
 
+def test_decoupled_weight_decay():
+  opt = YFOptimizer(learning_rate=0.5, momentum=0.5, zero_debias=False,
+                    weight_decay=0.1)
+  w = tf.Variable(np.ones([n_dim, ] ), dtype=tf.float32, name="w", trainable=True)
+  b = tf.Variable(np.ones([1, ], dtype=np.float32), dtype=tf.float32, name="b", trainable=True)
+
+  # zero gradients, so only the decay moves w, and b is not decayed
+  w_grad_val = tf.zeros([n_dim, ], dtype=tf.float32)
+  b_grad_val = tf.zeros([1, ], dtype=tf.float32)
+  apply_op = opt.apply_gradients(zip([w_grad_val, b_grad_val], [w, b] ),
+                                 decay_var_list=[w, ] )
+
+  init_op = tf.global_variables_initializer()
+  with tf.Session() as sess:
+    sess.run(init_op)
+    sess.run(apply_op)
+    w_val, b_val = sess.run( [w, b] )
+    # the first step uses the initial lr 0.5 before tuning starts
+    assert np.all(np.abs(w_val - (1.0 - 0.5 * 0.1) ) < 1e-6)
+    assert np.all(b_val == 1.0)
+  print("decoupled weight decay test passed!")
+
+
+def check_sparse_update(zero_debias):
+  n_row = 100
+  n_col = 10
+  sparse_window = 7
+  np.random.seed(1)
+  w_init = np.random.randn(n_row, n_col).astype(np.float32)
+  w_dense = tf.Variable(w_init, name="w_dense", trainable=True)
+  w_sparse = tf.Variable(w_init, name="w_sparse", trainable=True)
+
+  # embedding like gradient, with repeated rows
+  indices = tf.placeholder(tf.int32, shape=(None, ) )
+  values = tf.placeholder(tf.float32, shape=(None, n_col) )
+  grad = ops.IndexedSlices(values, indices, tf.constant([n_row, n_col] ) )
+
+  opt_dense = YFOptimizer(zero_debias=zero_debias)
+  opt_sparse = YFOptimizer(zero_debias=zero_debias, sparse_update=True,
+                           sparse_window=sparse_window)
+  dense_op = opt_dense.apply_gradients(
+    [(tf.convert_to_tensor(grad), w_dense), ] )
+  sparse_op = opt_sparse.apply_gradients( [(grad, w_sparse), ] )
+  flush_op = opt_sparse.sparse_flush_op()
+
+  def step(sess, rows):
+    feed_dict = {indices: np.random.choice(rows, size=[8, ] ),
+                 values: np.random.randn(8, n_col).astype(np.float32) }
+    res = sess.run( [opt_dense._grad_var, opt_sparse._grad_var,
+                     opt_dense._h_max, opt_sparse._h_max,
+                     dense_op, sparse_op], feed_dict=feed_dict)
+    assert np.abs(res[0] - res[1] ) < np.abs(res[0] ) * 1e-3
+    assert np.abs(res[2] - res[3] ) < np.abs(res[2] ) * 1e-3
+
+  init_op = tf.global_variables_initializer()
+  with tf.Session() as sess:
+    sess.run(init_op)
+    for i in range(n_iter):
+      step(sess, np.arange(n_row) )
+    # the skipped rows only catch up on their momentum when flushed
+    sess.run(flush_op)
+    w_dense_val, w_sparse_val = sess.run( [w_dense, w_sparse] )
+    assert np.all(np.abs(w_dense_val - w_sparse_val) < 1e-4)
+
+    # leave the first half of the rows untouched for a few steps inside
+    # the window, then for longer than the window
+    idle_rows = np.arange(n_row // 2)
+    for n_idle in [3, 2 * sparse_window + 1]:
+      for i in range(n_idle):
+        step(sess, np.arange(n_row // 2, n_row) )
+      sess.run(flush_op)
+      w_dense_val, w_sparse_val = sess.run( [w_dense, w_sparse] )
+      assert np.all(np.abs(w_dense_val[idle_rows]
+                           - w_sparse_val[idle_rows] ) < 1e-4)
+      assert np.all(np.abs(w_dense_val - w_sparse_val) < 1e-4)
+  print("sparse update test passed with zero_debias=%s!" % zero_debias)
+
+
+def test_sparse_update():
+  check_sparse_update(zero_debias=False)
+
+
+def test_sparse_update_zero_debias():
+  check_sparse_update(zero_debias=True)
+
+
 if __name__ == "__main__":
   # test gpu mode
   with tf.variable_scope("test_sync_measurement"):
@@ -167,6 +254,12 @@ if __name__ == "__main__":
     test_lr_mu()
     end = time.time()
     print("GPU lr and mu test done in ", (end - start)/float(n_iter), " s/iter!")
+  with tf.variable_scope("test_sync_weight_decay"):
+    test_decoupled_weight_decay()
+  with tf.variable_scope("test_sync_sparse_update"):
+    test_sparse_update()
+  with tf.variable_scope("test_sync_sparse_update_zero_debias"):
+    test_sparse_update_zero_debias()
 
   # test cpu mode
   with tf.variable_scope("test_sync_measurement_cpu"), tf.device("cpu:0"):
@@ -179,3 +272,10 @@ if __name__ == "__main__":
     test_lr_mu()
     end = time.time()
     print("CPU lr and mu test done in ", (end - start)/float(n_iter), " s/iter!")
+  with tf.variable_scope("test_sync_weight_decay_cpu"), tf.device("cpu:0"):
+    test_decoupled_weight_decay()
+  with tf.variable_scope("test_sync_sparse_update_cpu"), tf.device("cpu:0"):
+    test_sparse_update()
+  with tf.variable_scope("test_sync_sparse_update_zero_debias_cpu"), \
+      tf.device("cpu:0"):
+    test_sparse_update_zero_debias()